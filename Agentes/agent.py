@@ -1,5 +1,10 @@
 from mesa import Agent
 
+# States a box can be in, used by the model to count the boxes
+LOOSE = "loose"
+PICKED = "picked"
+PLACED = "placed"
+
 
 class Robot(Agent):
     """
@@ -18,37 +23,32 @@ class Robot(Agent):
         self.has_box = False
         self.box = None
         self.move_random_with_box = False
+        # stacking zone the robot takes its box to
+        self.zone = None
+
+    @property
+    def ideal_position(self):
+        """
+        The position where the robot has to stack the box it carries
+        """
+        return self.model.ideal_positions[self.zone]
 
     def step(self):
         """
         A step of the agent, if the agent moves a box to the ideal position
-        and it reaches the limit of 5, it will generate a new ideal position
-        inside the model. It will also move the agent
-        """
-        if len(self.model.grid.get_cell_list_contents(
-                [self.model.ideal_position])) == 5:
-            ideal_x = self.model.ideal_position[0]
-            ideal_y = self.model.ideal_position[1]
-            # works as a failsafe in case there is a robot in the next to
-            # be ideal position
-            while len(self.model.grid.get_cell_list_contents(
-                    [(ideal_x, ideal_y)])) != 0:
-                if ideal_x == self.model.get_last_x_position():
-                    ideal_y += 1
-                    ideal_x = 0
-                    self.model.all_stacking_positions.append(
-                        (ideal_x, ideal_y))
-
-                else:
-                    ideal_x += 1
-                    self.model.all_stacking_positions.append(
-                        (ideal_x, ideal_y))
-
-            self.model.ideal_position = (ideal_x, ideal_y)
-            self.model.all_stacking_positions.append(self.model.ideal_position)
-
+        and it reaches the stack height of the model, it will generate a new
+        ideal position inside the model. It will also move the agent
+        """
+        self.update_ideal_position()
         self.move()
 
+    def update_ideal_position(self):
+        """
+        If the stack in an ideal position reached the stack height, ask the
+        model for a new ideal position
+        """
+        self.model.update_ideal_positions()
+
     def move(self):
         """
         Move the robot randomly until it finds a box to pick it up, then move
@@ -60,160 +60,140 @@ class Robot(Agent):
         else:
             if self.get_neighboor_box_position() is not None:
                 self.pick_box()
+            elif self.model.box_search is not None:
+                self.move_to_box()
             else:
                 self.move_randomly()
 
+    def move_to_box(self):
+        """
+        Move one step towards the box claimed in the box search of the
+        model. If there is no box to claim or the way is blocked, move
+        randomly
+        """
+        claim = self.model.box_search.get_claim(self)
+        if claim is not None:
+            next_position = self.model.box_search.next_position(self, claim)
+            if next_position is not None:
+                self.model.grid.move_agent(self, next_position)
+                self.model.movements += 1
+                return
+        self.move_randomly()
+
     def move_randomly(self):
         """
         Moves the robot randomly until it finds a box to pick it up
         """
-        # Move randomly until it finds a box to move while not
-        # colliding with anything
-        possible_positions = self.model.grid.get_neighborhood(
-            self.pos, moore=False, include_center=False)
-        if len(possible_positions) > 0:
-            # make copy of possible_positions to avoid changing the
-            # original list
-            possible_positions_copy = possible_positions.copy()
-            # select a random position from the possible positions
-            new_position = self.random.choice(possible_positions_copy)
-
-            # get a new position until it is a position that is not a
-            # stacked box location
-            while new_position in self.model.all_stacking_positions:
-                # if there are non, return
-                if len(possible_positions_copy) == 0:
-                    return
-                new_position = self.random.choice(possible_positions_copy)
-
-            # iterate until a viable position is found, is none is found
-            # stay in the same position
-            while len(self.model.grid.get_cell_list_contents([new_position])) \
-                    != 0:
-                random_cell_content = \
-                    self.model.grid.get_cell_list_contents([new_position])
-                if len(random_cell_content) == 0:
-                    if new_position not in self.model.all_stacking_positions:
-                        self.model.grid.move_agent(self, new_position)
-                        self.model.movements += 1
-                        return
-                else:
-                    possible_positions_copy.remove(new_position)
-                    if len(possible_positions_copy) == 0:
-                        for agent in self.model.grid.iter_neighbors(
-                                self.pos, moore=False, include_center=False):
-                            if isinstance(agent, Robot) and \
-                                    len(self.model.grid.get_cell_list_contents(
-                                        [new_position])) == 2:
-                                agent.move_random_with_box = True
-                        self.model.grid.move_agent(
-                            self, (self.pos[0], self.pos[1]))
-                        return
+        grid = self.model.grid
+        new_position = self.choose_random_position()
+        if new_position is not None:
+            grid.move_agent(self, new_position)
+            self.model.movements += 1
+            return
+        # if there are no free positions stay in the same position
+        grid.move_agent(self, (self.pos[0], self.pos[1]))
 
-                    new_position = self.random.choice(possible_positions_copy)
+    def move_randomly_with_box(self):
+        """
+        Moves the robot and its box to a random free neighbor cell
+        """
+        new_position = self.choose_random_position()
+        if new_position is not None:
+            self.move_with_box(new_position[0], new_position[1])
+            self.model.movements += 1
+            return
+        # if there are no free positions stay in the same position
+        self.move_with_box(self.pos[0], self.pos[1])
 
-            # case in which there is a viable position
-            if new_position not in self.model.all_stacking_positions:
-                self.model.grid.move_agent(self, new_position)
-                self.model.movements += 1
-                return
-        # if there are no possible positions, return and do nothing
-        for agent in self.model.grid.iter_neighbors(
-                self.pos, moore=False, include_center=False):
-            if isinstance(agent, Robot) and \
-                    len(self.model.grid.get_cell_list_contents(
-                        [new_position])) == 2:
-                agent.move_random_with_box = True
-        self.model.grid.move_agent(self, (self.pos[0], self.pos[1]))
-        return
+    def choose_random_position(self):
+        """
+        Choose a random neighbor cell the robot can move to. The stacking
+        positions are left out before choosing, so the robot never waits for
+        them to become free. If every cell is taken and the last one tried
+        has a robot with a box, the robots next to this one are ordered to
+        move randomly on the next step
 
-    def move_randomly_with_box(self):
-        # Move randomly until it finds a box to move while
-        # not colliding with anything
-        possible_positions = self.model.grid.get_neighborhood(
-            self.pos, moore=False, include_center=False)
-        if len(possible_positions) > 0:
-            # make copy of possible_positions to avoid changing
-            # the original list
-            possible_positions_copy = possible_positions.copy()
-            # select a random position from the possible positions
-            new_position = self.random.choice(possible_positions_copy)
-
-            # get a new position until it is a position that is not
-            # a stacked box location
-            while new_position in self.model.all_stacking_positions:
-                # if there are non, return
-                if len(possible_positions_copy) == 0:
-                    return
-                new_position = self.random.choice(possible_positions_copy)
-
-            # iterate until a viable position is found, is none is found stay
-            # in the same position
-            while len(self.model.grid.get_cell_list_contents([new_position])) \
-                    != 0:
-                random_cell_content = self.model.grid.get_cell_list_contents(
-                    [new_position])
-                if len(random_cell_content) == 0:
-                    if new_position not in self.model.all_stacking_positions:
-                        self.move_with_box(new_position[0], new_position[1])
-                        self.model.movements += 1
-                        return
-                else:
-                    # If there is no position to move and there is a robot
-                    # with a box next to it, order it to move on the next step
-                    possible_positions_copy.remove(new_position)
-                    if len(possible_positions_copy) == 0:
-                        for agent in self.model.grid.iter_neighbors(
-                                self.pos, moore=False, include_center=False):
-                            if isinstance(agent, Robot) and \
-                                    len(self.model.grid.get_cell_list_contents(
-                                        [new_position])) == 2:
-                                agent.move_random_with_box = True
-                        self.move_with_box(self.pos[0], self.pos[1])
-                        return
-                    new_position = self.random.choice(possible_positions_copy)
+        Returns:
+            tuple: the coordinates of the cell, None if there is no free cell
+        """
+        grid = self.model.grid
+        possible_positions = [
+            position for position in grid.get_neighborhood(
+                self.pos, moore=False, include_center=False)
+            if not grid.is_stacking_position(position)]
+        new_position = None
+        # try random positions until a free one is found
+        while possible_positions:
+            new_position = self.random.choice(possible_positions)
+            if grid.cell_count(new_position) == 0:
+                return new_position
+            possible_positions.remove(new_position)
+        if new_position is not None:
+            self.model.record_collisions()
+            self.order_neighbors_to_move(new_position)
+        return None
+
+    def can_enter(self, position):
+        """
+        Returns whether the robot can move to a cell or leave its box there
 
-            # case in which there is a viable position
-            if new_position not in self.model.all_stacking_positions:
-                self.move_with_box(new_position[0], new_position[1])
-                self.model.movements += 1
-                return
-        # if there are no possible positions, return and do nothing
-        for agent in self.model.grid.iter_neighbors(
+        Args:
+            position (tuple): the coordinates of the cell
+
+        Returns:
+            bool: True if the cell is in the grid, empty and not a stacking
+                position
+        """
+        grid = self.model.grid
+        return not grid.out_of_bounds(position) and \
+            not grid.is_stacking_position(position) and \
+            grid.cell_count(position) == 0
+
+    def order_neighbors_to_move(self, position):
+        """
+        If the given position holds a robot carrying a box, order every robot
+        next to this one to move randomly with its box on the next step
+
+        Args:
+            position (tuple): the position the robot could not move to
+        """
+        grid = self.model.grid
+        if grid.cell_count(position) != 2:
+            return
+        for neighboor in grid.iter_neighborhood(
                 self.pos, moore=False, include_center=False):
-            if isinstance(agent, Robot) and \
-                    len(self.model.grid.get_cell_list_contents(
-                        [new_position])) == 2:
-                agent.move_random_with_box = True
-        self.move_with_box(self.pos[0], self.pos[1])
-        return
+            robot = grid.robot_at(neighboor)
+            if robot is not None:
+                robot.move_random_with_box = True
 
     def get_neighboor_box_position(self):
-        """Searches its neighborhood for a box and returns its position if
-        it exists
+        """Searches its neighborhood for a box that is neither picked nor
+        placed and returns its position if it exists. A box in the ideal
+        position is preferred, otherwise one of the neighbor cells with a
+        box is chosen at random
 
         Returns:
             coordinates: the coordinates of the position of the box
         """
-        for neighboor in self.model.grid.iter_neighbors(
+        grid = self.model.grid
+        # count the neighbor cells with a loose box
+        cells_with_box = 0
+        for neighboor in grid.iter_neighborhood(
                 self.pos, moore=False, include_center=False):
-            if isinstance(neighboor, Box) and \
-                    neighboor.pos == self.model.ideal_position:
-                if neighboor.is_picked == False and \
-                        neighboor.is_placed_correctly == False:
-                    return neighboor.pos
-        # Get the position of the box in the neighborhood of the robot
-        neighboors_with_box = []
-        for neighboor in self.model.grid.iter_neighbors(
+            if grid.loose_boxes_in_cell(neighboor) > 0:
+                if neighboor in self.model.ideal_positions:
+                    return neighboor
+                cells_with_box += 1
+        if cells_with_box == 0:
+            return None  # No box found
+
+        chosen = self.random.randrange(cells_with_box)
+        for neighboor in grid.iter_neighborhood(
                 self.pos, moore=False, include_center=False):
-            if isinstance(neighboor, Box):
-                neighboors_with_box.append(neighboor)
-        if len(neighboors_with_box) > 0:
-            chosen_box = self.random.choice(neighboors_with_box)
-            if chosen_box.is_picked == False and \
-                    chosen_box.is_placed_correctly == False:
-                return chosen_box.pos
-        return None  # No box found
+            if grid.loose_boxes_in_cell(neighboor) > 0:
+                if chosen == 0:
+                    return neighboor
+                chosen -= 1
 
     def pick_box(self):
         """
@@ -222,11 +202,23 @@ class Robot(Agent):
         """
         box_pos = self.get_neighboor_box_position()
         if box_pos is not None:
-            box = self.model.grid.get_cell_list_contents([box_pos])[0]
-            self.box = box
-            box.is_picked = True
-            self.has_box = True
-            self.model.grid.move_agent(self.box, self.pos)
+            self.pick_box_at(box_pos)
+
+    def pick_box_at(self, position):
+        """
+        Pick a loose box of the given cell
+
+        Args:
+            position (tuple): the position of the box
+        """
+        box = self.model.grid.get_loose_box(position)
+        if self.model.box_search is not None:
+            self.model.box_search.release(self)
+        self.box = box
+        box.is_picked = True
+        self.has_box = True
+        self.model.grid.move_agent(self.box, self.pos)
+        self.model.assign_zone(self)
 
     def move_to_ideal_position(self):
         """
@@ -235,282 +227,316 @@ class Robot(Agent):
             then all the way to the ideal position moving to the left
             until the ideal position is reached
         """
-        ideal_position = self.model.ideal_position
+        grid = self.model.grid
+        ideal_position = self.ideal_position
         # If its the ideal position, stack the box
-        for position in self.model.grid.iter_neighborhood(
-                self.pos, moore=False, include_center=False):
-            if position == ideal_position:
-                self.model.grid.move_agent(self.box, position)
-                self.box.is_placed_correctly = True
-                self.has_box = False
-                self.box = None
-                return
+        if self.stack_box():
+            return
 
         # If the order on the previous step ordered it to move,
         # then move randomly with the box so that it does not get stuck
         if self.move_random_with_box:
-            print("move random with box")
             self.move_randomly_with_box()
             self.move_random_with_box = False
             return
 
+        # Follow the planned path if the model has a path planner, if there
+        # is no way use the rules below
+        if self.model.path_planner is not None and \
+                self.move_along_path(ideal_position):
+            return
+
         if self.pos[0] < ideal_position[0]:
-            go_to_cell = self.model.grid.get_cell_list_contents(
-                [(self.pos[0] + 1, self.pos[1])])
-            if len(go_to_cell) != 0:
+            go_to_cell = (self.pos[0] + 1, self.pos[1])
+            go_to_count = grid.cell_count(go_to_cell)
+            if go_to_count != 0:
+                robot = grid.robot_at(go_to_cell)
                 # If it is a robot with a box, order it to move
-                for agent in go_to_cell:
-                    if isinstance(agent, Robot) and len(go_to_cell) == 2:
-                        agent.move_random_with_box = True
+                if robot is not None and go_to_count == 2:
+                    robot.move_random_with_box = True
+                    self.model.record_collisions()
+                    self.move_with_box(self.pos[0], self.pos[1])
+                    return
+                # If there is a robot with no box or a sole box
+                if go_to_count == 1:
+                    # If there is a robot in the way,
+                    # stay in the same position
+                    if robot is not None:
+                        self.model.record_collisions()
                         self.move_with_box(self.pos[0], self.pos[1])
                         return
-                # If there is a robot with no box or a sole box
-                if len(go_to_cell) == 1:
-                    for agent in go_to_cell:
-                        # If there is a robot in the way,
-                        # stay in the same position
-                        if isinstance(agent, Robot):
-                            self.move_with_box(self.pos[0], self.pos[1])
-                            return
-                        # If there is a box in the position to go to
-                        if isinstance(agent, Box):
-                            # If there is a box in the way, leave the box
-                            # if possible in the back
-                            # and pick up the new box
-                            if not self.model.grid.out_of_bounds(
-                                    (self.pos[0] - 1, self.pos[1])):
-                                if len(self.model.grid.get_cell_list_contents(
-                                        [(self.pos[0] - 1, self.pos[1])])) \
-                                        == 0:
-                                    self.model.grid.move_agent(
-                                        self.box, (
-                                            self.pos[0] - 1, self.pos[1]))
-                                    self.box.is_picked = False
-                                    self.has_box = False
-                                    self.box = None
-                                    return
-                            # If there is a box in the way and there is no
-                            # space to leave the box,
-                            # move in the y position
-                            if not self.model.grid.out_of_bounds(
-                                    (self.pos[0], self.pos[1] + 1)) and \
-                                    (self.pos[0], self.pos[1] + 1) not in \
-                                    self.model.all_stacking_positions and \
-                                    len(self.model.grid.get_cell_list_contents(
-                                        [(self.pos[0], self.pos[1] + 1)])) \
-                                    == 0:
-                                self.move_with_box(
-                                    self.pos[0], self.pos[1] + 1)
-                                self.model.movements += 1
-                                return
-                            else:
-                                if not self.model.grid.out_of_bounds(
-                                        (self.pos[0], self.pos[1] + 1)):
-                                    if len(self.model.grid.get_cell_list_contents(
-                                            [(self.pos[0], self.pos[1] + 1)])) \
-                                            == 0:
-                                        self.move_with_box(
-                                            self.pos[0], self.pos[1] + 1)
-                                        self.model.movements += 1
-                                        return
-                else:
-                    if len(self.model.grid.get_cell_list_contents(
-                            [(self.pos[0] + 1, self.pos[1])])) == 0:
-                        self.move_with_box(self.pos[0] + 1, self.pos[1])
+                    # If there is a box in the way, leave the box
+                    # if possible in the back
+                    # and pick up the new box
+                    if self.can_enter((self.pos[0] - 1, self.pos[1])):
+                        self.drop_box((self.pos[0] - 1, self.pos[1]))
+                        return
+                    # If there is a box in the way and there is no
+                    # space to leave the box,
+                    # move in the y position
+                    if self.can_enter((self.pos[0], self.pos[1] + 1)):
+                        self.move_with_box(self.pos[0], self.pos[1] + 1)
                         self.model.movements += 1
                         return
 
             # if there is nothing in the way move to the selected position
-            if len(self.model.grid.get_cell_list_contents(
-                    [(self.pos[0] + 1, self.pos[1])])) == 0:
+            if self.can_enter(go_to_cell):
                 self.move_with_box(self.pos[0] + 1, self.pos[1])
                 self.model.movements += 1
                 return
 
         if self.pos[0] > ideal_position[0]:
-            go_to_cell = self.model.grid.get_cell_list_contents(
-                [(self.pos[0] - 1, self.pos[1])])
-            if len(go_to_cell) != 0:
-                for agent in go_to_cell:
-                    if isinstance(agent, Robot) and len(go_to_cell) == 2:
-                        agent.move_random_with_box = True
+            go_to_cell = (self.pos[0] - 1, self.pos[1])
+            go_to_count = grid.cell_count(go_to_cell)
+            if go_to_count != 0:
+                robot = grid.robot_at(go_to_cell)
+                if robot is not None and go_to_count == 2:
+                    robot.move_random_with_box = True
+                    self.model.record_collisions()
+                    self.move_with_box(self.pos[0], self.pos[1])
+                    return
+                if go_to_count == 1:
+                    if robot is not None:
+                        self.model.record_collisions()
                         self.move_with_box(self.pos[0], self.pos[1])
                         return
-                if len(go_to_cell) == 1:
-                    for agent in go_to_cell:
-                        if isinstance(agent, Robot):
-                            self.move_with_box(self.pos[0], self.pos[1])
-                            return
-                        if isinstance(agent, Box):
-                            if not self.model.grid.out_of_bounds(
-                                    (self.pos[0] + 1, self.pos[1])):
-                                if len(self.model.grid.get_cell_list_contents(
-                                        [(self.pos[0] + 1, self.pos[1])])) == 0:
-                                    self.model.grid.move_agent(
-                                        self.box, (self.pos[0] + 1, self.pos[1]))
-                                    self.box.is_picked = False
-                                    self.has_box = False
-                                    self.box = None
-                                    return
-                            if not self.model.grid.out_of_bounds(
-                                    (self.pos[0], self.pos[1] - 1)) and \
-                                    (self.pos[0], self.pos[1] - 1) \
-                                    not in self.model.all_stacking_positions \
-                                    and \
-                                    len(self.model.grid.get_cell_list_contents([(self.pos[0], self.pos[1] - 1)])) == 0:
-                                self.move_with_box(
-                                    self.pos[0], self.pos[1] - 1)
-                                self.model.movements += 1
-                                return
-                            else:
-                                if not self.model.grid.out_of_bounds((self.pos[0], self.pos[1] + 1)):
-                                    if len(self.model.grid.get_cell_list_contents(
-                                            [(self.pos[0], self.pos[1] + 1)])) == 0:
-                                        self.move_with_box(
-                                            self.pos[0], self.pos[1] + 1)
-                                        self.model.movements += 1
-                                        return
-                else:
-                    if (self.pos[0] - 1, self.pos[1]) not in \
-                            self.model.all_stacking_positions and \
-                            len(self.model.grid.get_cell_list_contents(
-                                [(self.pos[0] - 1, self.pos[1])])) == 0:
-                        self.move_with_box(self.pos[0] - 1, self.pos[1])
+                    if self.can_enter((self.pos[0] + 1, self.pos[1])):
+                        self.drop_box((self.pos[0] + 1, self.pos[1]))
+                        return
+                    if self.can_enter((self.pos[0], self.pos[1] - 1)):
+                        self.move_with_box(self.pos[0], self.pos[1] - 1)
+                        self.model.movements += 1
+                        return
+                    if self.can_enter((self.pos[0], self.pos[1] + 1)):
+                        self.move_with_box(self.pos[0], self.pos[1] + 1)
                         self.model.movements += 1
                         return
 
-            if (self.pos[0] - 1, self.pos[1]) not in \
-                    self.model.all_stacking_positions and \
-                    len(self.model.grid.get_cell_list_contents(
-                        [(self.pos[0] - 1, self.pos[1])])) == 0:
+            if self.can_enter(go_to_cell):
                 self.move_with_box(self.pos[0] - 1, self.pos[1])
                 self.model.movements += 1
                 return
 
         if self.pos[1] < ideal_position[1]:
-            go_to_cell = self.model.grid.get_cell_list_contents(
-                [(self.pos[0], self.pos[1] + 1)])
-            if len(go_to_cell) != 0:
-                for agent in go_to_cell:
-                    if isinstance(agent, Robot) and len(go_to_cell) == 2:
-                        agent.move_random_with_box = True
+            go_to_cell = (self.pos[0], self.pos[1] + 1)
+            go_to_count = grid.cell_count(go_to_cell)
+            if go_to_count != 0:
+                robot = grid.robot_at(go_to_cell)
+                if robot is not None and go_to_count == 2:
+                    robot.move_random_with_box = True
+                    self.model.record_collisions()
+                    self.move_with_box(self.pos[0], self.pos[1])
+                    return
+                if go_to_count == 1:
+                    if robot is not None:
+                        self.model.record_collisions()
                         self.move_with_box(self.pos[0], self.pos[1])
                         return
-                if len(go_to_cell) == 1:
-                    for agent in go_to_cell:
-                        if isinstance(agent, Robot):
-                            self.move_with_box(self.pos[0], self.pos[1])
-                            return
-
-                        if isinstance(agent, Box):
-                            if not self.model.grid.out_of_bounds(
-                                    (self.pos[0] - 1, self.pos[1])):
-                                if len(self.model.grid.get_cell_list_contents(
-                                        [(self.pos[0] - 1, self.pos[1])])) == 0:
-                                    self.model.grid.move_agent(
-                                        self.box, 
-                                        (self.pos[0] - 1, self.pos[1]))
-                                    self.box.is_picked = False
-                                    self.has_box = False
-                                    self.box = None
-                                    return
-                            if not self.model.grid.out_of_bounds(
-                                    (self.pos[0] - 1, self.pos[1])) and \
-                                    (self.pos[0] - 1, self.pos[1]) not in \
-                                    self.model.all_stacking_positions and \
-                                    len(self.model.grid.get_cell_list_contents(
-                                        [(self.pos[0] - 1, self.pos[1])])) == 0:
-                                self.move_with_box(
-                                    self.pos[0] - 1, self.pos[1])
-                                self.model.movements += 1
-                                return
-                            else:
-                                if len(self.model.grid.get_cell_list_contents(
-                                        [(self.pos[0] + 1, self.pos[1])])) == 0:
-                                    self.move_with_box(
-                                        self.pos[0] + 1, self.pos[1])
-                                    self.model.movements += 1
-                                    return
-                else:
-                    self.move_with_box(self.pos[0], self.pos[1] + 1)
-                self.model.movements += 1
-                return
+                    if self.can_enter((self.pos[0] - 1, self.pos[1])):
+                        self.drop_box((self.pos[0] - 1, self.pos[1]))
+                        return
+                    if self.can_enter((self.pos[0] + 1, self.pos[1])):
+                        self.move_with_box(self.pos[0] + 1, self.pos[1])
+                        self.model.movements += 1
+                        return
 
-            if (self.pos[0], self.pos[1] + 1) not in \
-                    self.model.all_stacking_positions and \
-                    len(self.model.grid.get_cell_list_contents(
-                        [(self.pos[0], self.pos[1] + 1)])) == 0:
+            if self.can_enter(go_to_cell):
                 self.move_with_box(self.pos[0], self.pos[1] + 1)
                 self.model.movements += 1
                 return
 
         if self.pos[1] > ideal_position[1]:
-            go_to_cell = self.model.grid.get_cell_list_contents(
-                [(self.pos[0], self.pos[1] - 1)])
-            if len(go_to_cell) != 0:
-                for agent in go_to_cell:
-                    if isinstance(agent, Robot) and len(go_to_cell) == 2:
-                        agent.move_random_with_box = True
-
+            go_to_cell = (self.pos[0], self.pos[1] - 1)
+            go_to_count = grid.cell_count(go_to_cell)
+            if go_to_count != 0:
+                robot = grid.robot_at(go_to_cell)
+                if robot is not None and go_to_count == 2:
+                    robot.move_random_with_box = True
+                    self.model.record_collisions()
+                    self.move_with_box(self.pos[0], self.pos[1])
+                    return
+                if go_to_count == 1:
+                    if robot is not None:
+                        self.model.record_collisions()
                         self.move_with_box(self.pos[0], self.pos[1])
                         return
-                if len(go_to_cell) == 1:
-                    for agent in go_to_cell:
-                        if isinstance(agent, Robot):
-                            self.move_with_box(self.pos[0], self.pos[1])
-                            return
-                        if isinstance(agent, Box):
-                            # PRUEBA
-                            if not self.model.grid.out_of_bounds(
-                                    (self.pos[0], self.pos[1] + 1)):
-                                if len(self.model.grid.get_cell_list_contents(
-                                        [(self.pos[0], self.pos[1] + 1)])) == 0:
-                                    self.model.grid.move_agent(
-                                        self.box, 
-                                        (self.pos[0], self.pos[1] + 1))
-                                    self.box.is_picked = False
-                                    self.has_box = False
-                                    self.box = None
-                                    return
-                            if not self.model.grid.out_of_bounds(
-                                    (self.pos[0] + 1, self.pos[1])) and \
-                                    len(self.model.grid.get_cell_list_contents(
-                                        [(self.pos[0] + 1, self.pos[1])])) == 0:
-                                self.move_with_box(
-                                    self.pos[0] + 1, self.pos[1])
-                                self.model.movements += 1
-                                return
-                            else:
-                                if (self.pos[0] - 1, self.pos[1]) not in \
-                                        self.model.all_stacking_positions and \
-                                        len(self.model.grid.get_cell_list_contents([(self.pos[0] - 1, self.pos[1])])) \
-                                        == 0 and not \
-                                        self.model.grid.out_of_bounds(
-                                            (self.pos[0] - 1, self.pos[1])):
-                                    self.move_with_box(
-                                        self.pos[0] - 1, self.pos[1])
-                                    self.model.movements += 1
-                                    return
-                else:
-                    if (self.pos[0], self.pos[1] - 1) not in \
-                            self.model.all_stacking_positions and \
-                            len(self.model.grid.get_cell_list_contents(
-                                [(self.pos[0], self.pos[1] - 1)])) == 0:
-                        self.move_with_box(self.pos[0], self.pos[1] - 1)
+                    # PRUEBA
+                    if self.can_enter((self.pos[0], self.pos[1] + 1)):
+                        self.drop_box((self.pos[0], self.pos[1] + 1))
+                        return
+                    if self.can_enter((self.pos[0] + 1, self.pos[1])):
+                        self.move_with_box(self.pos[0] + 1, self.pos[1])
+                        self.model.movements += 1
+                        return
+                    if self.can_enter((self.pos[0] - 1, self.pos[1])):
+                        self.move_with_box(self.pos[0] - 1, self.pos[1])
                         self.model.movements += 1
                         return
 
-            if (self.pos[0], self.pos[1] - 1) not in \
-                    self.model.all_stacking_positions and \
-                    len(self.model.grid.get_cell_list_contents(
-                        [(self.pos[0], self.pos[1] - 1)])) == 0:
+            if self.can_enter(go_to_cell):
                 self.move_with_box(self.pos[0], self.pos[1] - 1)
                 self.model.movements += 1
                 return
 
-        else:
-            self.move_with_box(self.pos[0], self.pos[1])
-            return
+        # No rule could move the robot, move randomly with the box on the
+        # next step so that it does not get stuck behind the stacks
+        self.move_random_with_box = True
+        self.move_with_box(self.pos[0], self.pos[1])
+
+    def stack_box(self):
+        """
+        Leave the box in the ideal position if it is next to the robot
+
+        Returns:
+            bool: True if the box was stacked
+        """
+        ideal_position = self.ideal_position
+        for position in self.model.grid.iter_neighborhood(
+                self.pos, moore=False, include_center=False):
+            if position == ideal_position:
+                self.model.grid.move_agent(self.box, position)
+                self.box.is_placed_correctly = True
+                self.model.stacked_boxes += 1
+                self.has_box = False
+                self.box = None
+                self.model.release_zone(self)
+                return True
+        return False
+
+    def act_in_place(self):
+        """
+        Stack the box or pick a box next to the robot, the actions that do
+        not move the robot
+
+        Returns:
+            bool: True if the robot stacked or picked a box
+        """
+        if self.has_box:
+            return self.stack_box() or self.swap_box_in_the_way()
+        if self.get_neighboor_box_position() is not None:
+            self.pick_box()
+            return True
+        return False
+
+    def swap_box_in_the_way(self):
+        """
+        If every neighbor cell closer to the ideal position has a loose box,
+        leave the box the robot carries in an empty cell and pick up the box
+        in the way, as the rules of move_to_ideal_position do. If there is no
+        empty cell the box is left in the cell of the robot
+
+        Returns:
+            bool: True if the robot swapped the boxes
+        """
+        grid = self.model.grid
+        reservations = self.model.reservations
+        goal = self.ideal_position
+        distance = abs(self.pos[0] - goal[0]) + abs(self.pos[1] - goal[1])
+        in_the_way = None
+        empty = None
+        for neighboor in grid.iter_neighborhood(
+                self.pos, moore=False, include_center=False):
+            closer = abs(neighboor[0] - goal[0]) + \
+                abs(neighboor[1] - goal[1]) < distance
+            if closer and grid.loose_boxes_in_cell(neighboor) > 0:
+                if in_the_way is None:
+                    in_the_way = neighboor
+            elif closer and not grid.is_obstacle(neighboor):
+                # there is a way, the robot just has to move
+                return False
+            elif empty is None and grid.cell_count(neighboor) == 0 and \
+                    not grid.is_stacking_position(neighboor) and \
+                    (reservations is None or
+                     not reservations.is_reserved(neighboor)):
+                empty = neighboor
+        if empty is None and not grid.is_stacking_position(self.pos):
+            empty = self.pos
+        if in_the_way is None or empty is None:
+            return False
+        self.drop_box(empty)
+        self.pick_box_at(in_the_way)
+        return True
+
+    def get_candidate_positions(self):
+        """
+        Returns the neighbor cells the robot could move to, from the most to
+        the least wanted. A robot with a box wants the cells closer to the
+        ideal position, first the one of its planned path if the model has
+        a planner. A robot without a box wants the cell towards its claimed
+        box if the model has a box search, the rest in random order
+
+        Returns:
+            list: the coordinates of the cells
+        """
+        grid = self.model.grid
+        cells = [neighboor for neighboor in grid.iter_neighborhood(
+            self.pos, moore=False, include_center=False)
+            if not grid.is_obstacle(neighboor)]
+        self.random.shuffle(cells)
+
+        preferred = None
+        if self.has_box:
+            goal = self.ideal_position
+            cells.sort(key=lambda cell: abs(cell[0] - goal[0]) +
+                       abs(cell[1] - goal[1]))
+            if self.model.path_planner is not None:
+                planned = self.model.path_planner.get_path(self.pos, goal)
+                if planned is not None:
+                    path, index = planned
+                    preferred = path[index + 1]
+        elif self.model.box_search is not None:
+            claim = self.model.box_search.get_claim(self)
+            if claim is not None:
+                preferred = self.model.box_search.next_position(self, claim)
+
+        if preferred in cells:
+            cells.remove(preferred)
+            cells.insert(0, preferred)
+        return cells
+
+    def move_along_path(self, goal):
+        """
+        Move the robot and its box one cell along the planned path to the
+        goal. If the next cell is taken, plan again around it
+
+        Args:
+            goal (tuple): the position where the box is going
+
+        Returns:
+            bool: True if the robot moved
+        """
+        planner = self.model.path_planner
+        grid = self.model.grid
+        planned = planner.get_path(self.pos, goal)
+        if planned is None:
+            return False
+        path, index = planned
+        next_position = path[index + 1]
+        if grid.cell_count(next_position) != 0:
+            planned = planner.get_path(
+                self.pos, goal, blocked={next_position})
+            if planned is None:
+                return False
+            path, index = planned
+            next_position = path[index + 1]
+        if next_position == goal or grid.cell_count(next_position) != 0:
+            return False
+        self.move_with_box(next_position[0], next_position[1])
+        self.model.movements += 1
+        return True
+
+    def drop_box(self, position):
+        """
+        Leave the box the robot is carrying in the given position
+
+        Args:
+            position (tuple): the position to leave the box in
+        """
+        self.model.grid.move_agent(self.box, position)
+        self.box.is_picked = False
+        self.has_box = False
+        self.box = None
+        self.model.release_zone(self)
 
     def move_with_box(self, x, y):
         """
@@ -525,17 +551,70 @@ class Box(Agent):
     A box agent that will be moved
     """
 
-    def __init__(self, unique_id, model):
+    def __init__(self, unique_id, model, new=True):
         """
         Create a new Box agent.
 
         Args:
             unique_id (_type_): Unique identifier for the agent
             model (_type_): the model the agent is part of
+            new (bool): whether the box is new to the model, False when a
+                box kept in the arrays of a CompactOccupancyGrid becomes an
+                agent, since the model already counts it
         """
         super().__init__(unique_id, model)
-        self.is_picked = False
-        self.is_placed_correctly = False
+        self._is_picked = False
+        self._is_placed_correctly = False
+        if new:
+            self.model.update_box_count(None, self.get_state())
+
+    @property
+    def is_picked(self):
+        return self._is_picked
+
+    @is_picked.setter
+    def is_picked(self, value):
+        self.set_state(value, self._is_placed_correctly)
+
+    @property
+    def is_placed_correctly(self):
+        return self._is_placed_correctly
+
+    @is_placed_correctly.setter
+    def is_placed_correctly(self, value):
+        self.set_state(self._is_picked, value)
+
+    def get_state(self):
+        """
+        Get the state of the box
+
+        Returns:
+            str: PLACED if the box is stacked, PICKED if a robot carries it
+                and LOOSE otherwise
+        """
+        if self._is_placed_correctly:
+            return PLACED
+        if self._is_picked:
+            return PICKED
+        return LOOSE
+
+    def set_state(self, is_picked, is_placed_correctly):
+        """
+        Change the flags of the box and let the model update its counters.
+        Every change of the flags goes through here
+
+        Args:
+            is_picked (bool): whether a robot carries the box
+            is_placed_correctly (bool): whether the box is stacked
+        """
+        old_state = self.get_state()
+        self._is_picked = is_picked
+        self._is_placed_correctly = is_placed_correctly
+        new_state = self.get_state()
+        self.model.update_box_count(old_state, new_state)
+        # keep the indexes of the grid up to date
+        if self.pos is not None and old_state != new_state:
+            self.model.grid.update_box_state(self, old_state, new_state)
 
     def step(self):
         """
@@ -550,4 +629,4 @@ class Box(Agent):
         Returns:
             int: the number of boxes in the stack
         """
-        return len(self.model.grid.get_cell_list_contents([self.pos]))
+        return self.model.grid.cell_count(self.pos)
@@ -0,0 +1,229 @@
+"""
+Headless batch runs of the BoxPicking model. Every combination of the given
+parameters is run in a pool of worker processes and the result of each run
+is appended to a JSON lines file as soon as it finishes, so an interrupted
+sweep can be resumed by running the same command again. With --data-dir
+the data of every step of each run is also streamed to its own directory,
+and with --trace-dir each run is recorded as a trace that the server can
+replay.
+
+Example:
+    python batch_run.py --width 15 30 --height 15 30 --boxes 115 \\
+        --robots 5 10 --max-steps 5000 --replicates 20 \\
+        --output results.jsonl
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from model import BoxPicking
+
+# Parameters that identify a run inside a sweep
+RUN_KEYS = ("width", "height", "n_boxes", "n_robots", "max_steps", "seed")
+
+
+def build_sweep(widths, heights, n_boxes, max_steps, replicates=1, seed=0,
+                n_robots=(5,)):
+    """
+    Build the configurations of a sweep, one for every combination of the
+    parameters and replicate
+
+    Args:
+        widths (list): the widths of the grid
+        heights (list): the heights of the grid
+        n_boxes (list): the numbers of boxes
+        max_steps (list): the maximum numbers of steps
+        replicates (int): the number of runs of each combination
+        seed (int): the seed of the first replicate, the next ones use
+            consecutive seeds
+        n_robots (list): the numbers of robots
+
+    Returns:
+        list: the configurations as dictionaries
+    """
+    configurations = []
+    for width, height, boxes, robots, steps in itertools.product(
+            widths, heights, n_boxes, n_robots, max_steps):
+        for replicate in range(replicates):
+            configurations.append({"width": width,
+                                   "height": height,
+                                   "n_boxes": boxes,
+                                   "n_robots": robots,
+                                   "max_steps": steps,
+                                   "seed": seed + replicate})
+    return configurations
+
+
+def run_key(configuration):
+    """
+    Returns the key that identifies a run
+
+    Args:
+        configuration (dict): the configuration of the run
+
+    Returns:
+        tuple: the values of the parameters of the run
+    """
+    return tuple(configuration[key] for key in RUN_KEYS)
+
+
+def run_configuration(configuration, data_dir=None, trace_dir=None):
+    """
+    Run a model until it stops and return its results. The model prints
+    while it runs, so its output is discarded
+
+    Args:
+        configuration (dict): the configuration of the run
+        data_dir (str): if given, the data of every step is streamed to a
+            directory of the run inside it
+        trace_dir (str): if given, the run is recorded in a trace file of
+            the run inside it
+
+    Returns:
+        dict: the configuration together with the results of the run
+    """
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = BoxPicking(configuration["width"],
+                           configuration["height"],
+                           configuration["n_boxes"],
+                           configuration["max_steps"],
+                           seed=configuration["seed"],
+                           n_robots=configuration["n_robots"])
+        if data_dir is not None:
+            model.stream_data(os.path.join(data_dir, run_name(configuration)))
+        if trace_dir is not None:
+            model.record_trace(os.path.join(
+                trace_dir, run_name(configuration) + ".trace"))
+        while model.running:
+            model.step()
+
+    result = dict(configuration)
+    result["steps"] = model.schedule.steps
+    result["movements"] = model.movements
+    result["placed_boxes"] = model.placed_boxes
+    # the placed boxes without the ones found in a stacking position
+    result["stacked_boxes"] = model.stacked_boxes
+    result["completed"] = model.placed_boxes == model.number_of_boxes
+    result["elapsed"] = time.perf_counter() - start
+    return result
+
+
+def run_name(configuration):
+    """
+    Returns the name of the data directory of a run
+
+    Args:
+        configuration (dict): the configuration of the run
+
+    Returns:
+        str: the parameters of the run joined by "_"
+    """
+    return "_".join(f"{key}-{configuration[key]}" for key in RUN_KEYS)
+
+
+def load_finished_runs(output_path):
+    """
+    Read the keys of the runs already saved in the output file
+
+    Args:
+        output_path (str): the path of the JSON lines file
+
+    Returns:
+        set: the keys of the finished runs
+    """
+    finished = set()
+    if not os.path.exists(output_path):
+        return finished
+    with open(output_path) as output:
+        for line in output:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                finished.add(run_key(json.loads(line)))
+            except (ValueError, KeyError):
+                # a line cut by an interrupted run, it is run again
+                continue
+    return finished
+
+
+def run_sweep(configurations, output_path, workers=None, resume=True,
+              data_dir=None, trace_dir=None):
+    """
+    Run every configuration in a pool of processes and append each result
+    to the output file as soon as it is ready
+
+    Args:
+        configurations (list): the configurations to run
+        output_path (str): the path of the JSON lines file
+        workers (int): the number of processes, defaults to the number of
+            CPUs
+        resume (bool): skip the runs already saved in the output file
+        data_dir (str): if given, the data of every step of every run is
+            streamed to a directory of the run inside it
+        trace_dir (str): if given, every run is recorded in a trace file
+            inside it
+
+    Returns:
+        int: the number of runs done
+    """
+    if resume:
+        finished = load_finished_runs(output_path)
+        configurations = [configuration for configuration in configurations
+                          if run_key(configuration) not in finished]
+    else:
+        open(output_path, "w").close()
+
+    if trace_dir is not None:
+        os.makedirs(trace_dir, exist_ok=True)
+    done = 0
+    with open(output_path, "a") as output, \
+            ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_configuration, configuration,
+                                   data_dir, trace_dir)
+                   for configuration in configurations]
+        for future in as_completed(futures):
+            output.write(json.dumps(future.result()) + "\n")
+            output.flush()
+            done += 1
+            print(f"{done}/{len(futures)} runs done")
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run BoxPicking sweeps without a server")
+    parser.add_argument("--width", type=int, nargs="+", default=[15])
+    parser.add_argument("--height", type=int, nargs="+", default=[15])
+    parser.add_argument("--boxes", type=int, nargs="+", default=[115])
+    parser.add_argument("--robots", type=int, nargs="+", default=[5])
+    parser.add_argument("--max-steps", type=int, nargs="+", default=[5000])
+    parser.add_argument("--replicates", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default="results.jsonl")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="overwrite the output file instead of resuming")
+    parser.add_argument("--data-dir", default=None,
+                        help="stream the data of every step of every run to "
+                             "this directory")
+    parser.add_argument("--trace-dir", default=None,
+                        help="record a trace of every run in this directory")
+    args = parser.parse_args()
+
+    configurations = build_sweep(args.width, args.height, args.boxes,
+                                 args.max_steps, args.replicates, args.seed,
+                                 args.robots)
+    run_sweep(configurations, args.output, args.workers,
+              resume=not args.no_resume, data_dir=args.data_dir,
+              trace_dir=args.trace_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""
+Benchmarks of the BoxPicking model. Seeded models are built for every
+combination of grid size, box density, number of robots and mode, and for
+each one the time to build the model, the time of the steps, the steps and
+movements until the boxes are stacked and the peak memory are measured. The
+results are written as JSON and can be compared with a stored baseline, so
+a change to the agents comes with a before and after number.
+
+The steps and movements only depend on the seed, so any difference with the
+baseline means the behavior of the model changed. The times depend on the
+machine, compare them with a baseline made on the same machine.
+
+Example:
+    python benchmark.py --output after.json --baseline benchmark_baseline.json
+    python benchmark.py --save-baseline benchmark_baseline.json
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import mesa
+import numpy as np
+
+from model import BoxPicking
+
+# Parameters that identify a benchmark
+BENCHMARK_KEYS = ("width", "height", "n_boxes", "n_robots", "activation",
+                  "search", "planner", "seed")
+# Results that only depend on the seed
+EXACT_RESULTS = ("steps", "movements", "placed_boxes", "stacked_boxes")
+# Results that depend on the machine, compared as ratios
+TIMED_RESULTS = ("init_seconds", "step_seconds", "peak_memory")
+
+
+def build_matrix(sizes, densities, n_robots, activations=("random",),
+                 searches=("random",), planners=("greedy",), max_steps=5000,
+                 repeats=1, seed=0):
+    """
+    Build the configurations of the benchmarks, one for every combination
+    of the parameters and repeat
+
+    Args:
+        sizes (list): the widths of square grids
+        densities (list): the fractions of the cells with a box
+        n_robots (list): the numbers of robots
+        activations (list): the activations of the models
+        searches (list): the box searches of the models
+        planners (list): the path planners of the models
+        max_steps (int): the maximum number of steps of every run
+        repeats (int): the number of runs of each combination
+        seed (int): the seed of the first repeat, the next ones use
+            consecutive seeds
+
+    Returns:
+        list: the configurations as dictionaries
+    """
+    configurations = []
+    for size, density, robots, activation, search, planner in \
+            itertools.product(sizes, densities, n_robots, activations,
+                              searches, planners):
+        for repeat in range(repeats):
+            configurations.append({"width": size,
+                                   "height": size,
+                                   "n_boxes": int(size * size * density),
+                                   "n_robots": robots,
+                                   "activation": activation,
+                                   "search": search,
+                                   "planner": planner,
+                                   "max_steps": max_steps,
+                                   "seed": seed + repeat})
+    return configurations
+
+
+def benchmark_key(configuration):
+    """
+    Returns the key that identifies a benchmark
+
+    Args:
+        configuration (dict): the configuration of the benchmark
+
+    Returns:
+        tuple: the values of the parameters of the benchmark
+    """
+    return tuple(configuration[key] for key in BENCHMARK_KEYS)
+
+
+def build_model(configuration):
+    """
+    Build the model of a configuration
+
+    Args:
+        configuration (dict): the configuration of the benchmark
+
+    Returns:
+        BoxPicking: the model
+    """
+    return BoxPicking(configuration["width"],
+                      configuration["height"],
+                      configuration["n_boxes"],
+                      configuration["max_steps"],
+                      seed=configuration["seed"],
+                      activation=configuration["activation"],
+                      n_robots=configuration["n_robots"],
+                      search=configuration["search"],
+                      planner=configuration["planner"])
+
+
+def run_benchmark(configuration, memory=True):
+    """
+    Build and run the model of a configuration until it stops. The peak
+    memory is measured in a second run of the same seed, because tracing
+    the allocations slows down the first one
+
+    Args:
+        configuration (dict): the configuration of the benchmark
+        memory (bool): measure the peak memory
+
+    Returns:
+        dict: the configuration together with the results
+    """
+    # the model prints when it stops
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        model = build_model(configuration)
+        init_seconds = time.perf_counter() - start
+
+        step_times = []
+        while model.running:
+            start = time.perf_counter()
+            model.step()
+            step_times.append(time.perf_counter() - start)
+
+        peak_memory = None
+        if memory:
+            tracemalloc.start()
+            traced = build_model(configuration)
+            while traced.running:
+                traced.step()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    result = dict(configuration)
+    result["init_seconds"] = init_seconds
+    result["step_seconds"] = float(np.mean(step_times)) if step_times \
+        else 0.0
+    result["max_step_seconds"] = max(step_times, default=0.0)
+    result["steps"] = model.schedule.steps
+    result["movements"] = model.movements
+    result["placed_boxes"] = model.placed_boxes
+    result["stacked_boxes"] = model.stacked_boxes
+    result["completed"] = model.placed_boxes == model.number_of_boxes
+    result["peak_memory"] = peak_memory
+    return result
+
+
+def get_environment():
+    """
+    Returns the versions the benchmarks ran with
+
+    Returns:
+        dict: the versions and the platform
+    """
+    return {"python": platform.python_version(),
+            "numpy": np.__version__,
+            "mesa": mesa.__version__,
+            "platform": platform.platform()}
+
+
+def run_benchmarks(configurations, memory=True):
+    """
+    Run every benchmark one after the other, so they do not compete for the
+    processor
+
+    Args:
+        configurations (list): the configurations to run
+        memory (bool): measure the peak memory
+
+    Returns:
+        dict: the environment and the results
+    """
+    results = []
+    for number, configuration in enumerate(configurations, 1):
+        results.append(run_benchmark(configuration, memory))
+        print(f"{number}/{len(configurations)} benchmarks done",
+              file=sys.stderr)
+    return {"environment": get_environment(), "results": results}
+
+
+def compare(report, baseline):
+    """
+    Compare the results of a report with the ones of a baseline
+
+    Args:
+        report (dict): the report of run_benchmarks
+        baseline (dict): a report saved before
+
+    Returns:
+        list: for every benchmark in both, a dictionary with its key, the
+            ratio report / baseline of every timed result and the exact
+            results that changed as (baseline, report) pairs
+    """
+    baseline_results = {benchmark_key(result): result
+                        for result in baseline["results"]}
+    comparisons = []
+    for result in report["results"]:
+        key = benchmark_key(result)
+        before = baseline_results.get(key)
+        if before is None:
+            continue
+        ratios = {}
+        for name in TIMED_RESULTS:
+            if result.get(name) and before.get(name):
+                ratios[name] = result[name] / before[name]
+        # a baseline made before a result existed does not compare it
+        changed = {name: (before[name], result[name])
+                   for name in EXACT_RESULTS
+                   if name in before and before[name] != result[name]}
+        comparisons.append({"key": dict(zip(BENCHMARK_KEYS, key)),
+                            "ratios": ratios,
+                            "changed": changed})
+    return comparisons
+
+
+def print_comparisons(comparisons):
+    """
+    Print a line for every comparison
+
+    Args:
+        comparisons (list): the result of compare
+    """
+    for comparison in comparisons:
+        key = comparison["key"]
+        name = (f"{key['width']}x{key['height']} boxes={key['n_boxes']} "
+                f"robots={key['n_robots']} {key['activation']}/"
+                f"{key['search']}/{key['planner']} seed={key['seed']}")
+        ratios = " ".join(f"{metric}={ratio:.2f}x"
+                          for metric, ratio in comparison["ratios"].items())
+        print(f"{name}: {ratios}")
+        for metric, (before, after) in comparison["changed"].items():
+            print(f"    {metric} changed: {before} -> {after}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark BoxPicking models and compare them with a "
+                    "baseline")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[15, 30])
+    parser.add_argument("--densities", type=float, nargs="+",
+                        default=[0.1, 0.5])
+    parser.add_argument("--robots", type=int, nargs="+", default=[5, 20])
+    parser.add_argument("--activations", nargs="+", default=["random"])
+    parser.add_argument("--searches", nargs="+", default=["random"])
+    parser.add_argument("--planners", nargs="+", default=["greedy"])
+    parser.add_argument("--max-steps", type=int, default=5000)
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the run that measures the peak memory")
+    parser.add_argument("--output", default=None,
+                        help="write the results to this JSON file")
+    parser.add_argument("--baseline", default=None,
+                        help="compare the results with this JSON file")
+    parser.add_argument("--save-baseline", default=None,
+                        help="write the results as the new baseline")
+    args = parser.parse_args()
+
+    configurations = build_matrix(args.sizes, args.densities, args.robots,
+                                  args.activations, args.searches,
+                                  args.planners, args.max_steps,
+                                  args.repeats, args.seed)
+    report = run_benchmarks(configurations, memory=not args.no_memory)
+
+    for path in (args.output, args.save_baseline):
+        if path is not None:
+            with open(path, "w") as output:
+                json.dump(report, output, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline) as baseline:
+            print_comparisons(compare(report, json.load(baseline)))
+    elif args.output is None and args.save_baseline is None:
+        json.dump(report, sys.stdout, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,418 @@
+"""
+Checkpoints of a BoxPicking model. A checkpoint keeps everything a model
+needs to go on exactly as if it had not stopped: the parameters, the agents
+of every cell in order, the flags of the boxes and the robots, the stacking
+zones, the step counters, the state of the random number generators and the
+claims and paths the robots follow. It is saved as a compressed NumPy
+archive, so long runs can be saved and resumed.
+
+Example:
+    save_checkpoint(model, "run.npz")
+    model = load_checkpoint("run.npz")
+"""
+import json
+
+import numpy as np
+
+from agent import LOOSE, PICKED, PLACED
+from model import BoxPicking
+
+# Changes when the contents of a checkpoint change
+FORMAT_VERSION = 1
+# Parameters of BoxPicking a checkpoint can set, with their type. The last
+# ones are missing in the checkpoints saved before they existed
+INTEGER_PARAMETERS = ("width", "height", "n_boxes", "max_steps",
+                      "change_log_size", "n_robots", "stack_height")
+TEXT_PARAMETERS = ("activation", "search", "planner", "box_storage")
+OPTIONAL_PARAMETERS = ("box_storage", "profile_queries")
+POSITIVE_PARAMETERS = ("width", "height", "stack_height")
+
+
+def get_checkpoint(model):
+    """
+    Returns the checkpoint of a model
+
+    Args:
+        model (BoxPicking): the model
+
+    Returns:
+        dict: the NumPy arrays of the checkpoint by name
+    """
+    if model.box_storage == "compact":
+        agents, boxes = get_compact_agents(model)
+    else:
+        # (unique id, x, y) of every agent, in the order of the cells
+        # contents
+        agents = [(agent.unique_id, x, y)
+                  for cell_content, x, y in model.grid.coord_iter()
+                  for agent in cell_content]
+        boxes = [(box.unique_id, box.is_picked, box.is_placed_correctly)
+                 for box in model.box_agents]
+    robots = [(robot.unique_id, robot.has_box,
+               -1 if robot.box is None else robot.box.unique_id,
+               -1 if robot.zone is None else robot.zone,
+               robot.move_random_with_box)
+              for robot in model.schedule.agents]
+    version, random_state, gauss_next = model.random.getstate()
+
+    meta = {
+        "version": FORMAT_VERSION,
+        "parameters": {
+            "width": model.width,
+            "height": model.height,
+            "n_boxes": model.number_of_boxes,
+            "max_steps": model.max_steps,
+            "seed": model.seed,
+            "change_log_size": model.change_log.maxlen,
+            "activation": model.activation,
+            "n_robots": model.number_of_robots,
+            "search": model.search,
+            "planner": model.planner,
+            "stack_height": model.stack_height,
+            "stacking_zones": model.stacking_zones,
+            "profile": model.profiler is not None,
+            "profile_queries": model.profiler is not None and
+            model.profiler.count_queries,
+            "box_storage": model.box_storage,
+        },
+        "steps": model.schedule.steps,
+        "time": model.schedule.time,
+        "movements": model.movements,
+        "stacked_boxes": model.stacked_boxes,
+        "running": model.running,
+        "ideal_positions": model.ideal_positions,
+        "allocators": [(allocator.cursor, allocator.deferred)
+                       for allocator in model.stacking_allocators],
+        "zone_robots": model.zone_robots,
+        "random_version": version,
+        "gauss_next": gauss_next,
+    }
+    if hasattr(model.schedule, "rng"):
+        meta["numpy_random"] = model.schedule.rng.bit_generator.state
+    if model.box_search is not None:
+        meta["claims"] = list(model.box_search.claims.items())
+    if model.path_planner is not None:
+        meta["paths"], meta["lookup"] = get_planner_state(
+            model.path_planner)
+
+    return {
+        "meta": np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8),
+        "agents": np.array(agents, dtype=np.int64).reshape(-1, 3),
+        "boxes": np.array(boxes, dtype=np.int64).reshape(-1, 3),
+        "robots": np.array(robots, dtype=np.int64).reshape(-1, 5),
+        "stacking": np.array(sorted(model.all_stacking_positions),
+                             dtype=np.int64).reshape(-1, 2),
+        "random_state": np.array(random_state, dtype=np.uint32),
+    }
+
+
+def get_compact_agents(model):
+    """
+    Returns the agents of a model that keeps its boxes in the arrays of the
+    grid, with the robot of each cell first and then its boxes from the
+    bottom of the stack up
+
+    Args:
+        model (BoxPicking): the model
+
+    Returns:
+        tuple: the (unique id, x, y) rows of the agents and the
+            (unique id, is picked, is placed) rows of the boxes
+    """
+    grid = model.grid
+    agents = []
+    x, y = np.nonzero(grid.agent_count)
+    for position in zip(x.tolist(), y.tolist()):
+        robot = grid.robot_at(position)
+        if robot is not None:
+            agents.append((robot.unique_id,) + position)
+        agents.extend((unique_id,) + position
+                      for unique_id in grid.iter_box_ids(position))
+    return agents, grid.get_box_states()
+
+
+def get_planner_state(planner):
+    """
+    Returns the cached paths of a planner and the path each (cell, goal)
+    uses, with the paths numbered by their position in the list
+
+    Args:
+        planner (PathPlanner): the path planner of the model
+
+    Returns:
+        tuple: the list of paths and the list of lookup entries
+            (cell, goal, path number, index of the cell in the path)
+    """
+    numbers = {}
+    paths = []
+    for path_id, path in planner.paths.items():
+        numbers[path_id] = len(paths)
+        paths.append(path)
+    lookup = [(cell, goal, numbers[path_id], index)
+              for (cell, goal), (path_id, index) in planner.lookup.items()]
+    return paths, lookup
+
+
+def read_meta(checkpoint):
+    """
+    Returns the meta data of a checkpoint
+
+    Args:
+        checkpoint (dict): the NumPy arrays of the checkpoint by name
+
+    Returns:
+        dict: the meta data
+    """
+    meta = json.loads(bytes(checkpoint["meta"]))
+    if meta["version"] != FORMAT_VERSION:
+        raise ValueError(f"Unknown checkpoint version: {meta['version']}")
+    return meta
+
+
+def get_parameters(checkpoint):
+    """
+    Returns the parameters of the model of a checkpoint, checked so a
+    checkpoint from an untrusted source can only set the parameters a saved
+    model has, with values of the right type
+
+    Args:
+        checkpoint (dict): the NumPy arrays of the checkpoint by name
+
+    Returns:
+        dict: the keyword arguments of BoxPicking
+    """
+    parameters = dict(read_meta(checkpoint)["parameters"])
+    known = INTEGER_PARAMETERS + TEXT_PARAMETERS + \
+        ("seed", "profile", "profile_queries", "stacking_zones")
+    for name in known:
+        if name not in parameters and name not in OPTIONAL_PARAMETERS:
+            raise ValueError(f"Missing parameter: {name}")
+    for name, value in parameters.items():
+        if name not in known:
+            raise ValueError(f"Unknown parameter: {name}")
+        if name in INTEGER_PARAMETERS:
+            valid = is_integer(value) and value >= 0
+        elif name in TEXT_PARAMETERS:
+            valid = isinstance(value, str)
+        elif name == "seed":
+            valid = value is None or is_integer(value)
+        elif name in ("profile", "profile_queries"):
+            valid = isinstance(value, bool)
+        else:
+            valid = isinstance(value, list) and all(
+                isinstance(zone, list) and len(zone) == 4 and
+                all(is_integer(number) for number in zone)
+                for zone in value)
+        if not valid:
+            raise ValueError(f"Invalid parameter: {name}")
+    for name in POSITIVE_PARAMETERS:
+        if parameters.get(name, 1) < 1:
+            raise ValueError(f"Invalid parameter: {name}")
+    parameters["stacking_zones"] = [
+        tuple(zone) for zone in parameters["stacking_zones"]]
+    return parameters
+
+
+def is_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def restore_checkpoint(checkpoint):
+    """
+    Build the model saved in a checkpoint
+
+    Args:
+        checkpoint (dict): the NumPy arrays of the checkpoint by name
+
+    Returns:
+        BoxPicking: the model, in the same state as when it was saved
+    """
+    meta = read_meta(checkpoint)
+    parameters = get_parameters(checkpoint)
+    model = BoxPicking(**parameters)
+    grid = model.grid
+
+    if model.box_storage == "compact":
+        agents = restore_compact_agents(model, checkpoint)
+    else:
+        agents = restore_agents(model, checkpoint)
+    for unique_id, has_box, box_id, zone, move_random in \
+            checkpoint["robots"].tolist():
+        robot = agents[unique_id]
+        robot.has_box = bool(has_box)
+        robot.box = agents[box_id] if box_id >= 0 else None
+        robot.zone = zone if zone >= 0 else None
+        robot.move_random_with_box = bool(move_random)
+
+    for x, y in checkpoint["stacking"].tolist():
+        model.add_stacking_position((x, y))
+    model.ideal_positions = [tuple(position)
+                             for position in meta["ideal_positions"]]
+    for allocator, (cursor, deferred) in zip(model.stacking_allocators,
+                                             meta["allocators"]):
+        allocator.cursor = cursor
+        allocator.deferred = [tuple(position) for position in deferred]
+    model.zone_robots = meta["zone_robots"]
+
+    model.schedule.steps = meta["steps"]
+    model.schedule.time = meta["time"]
+    model.movements = meta["movements"]
+    model.stacked_boxes = meta.get("stacked_boxes", 0)
+    model.running = meta["running"]
+    model.random.setstate((meta["random_version"],
+                           tuple(checkpoint["random_state"].tolist()),
+                           meta["gauss_next"]))
+    if "numpy_random" in meta:
+        model.schedule.rng.bit_generator.state = meta["numpy_random"]
+    if model.box_search is not None:
+        restore_claims(model.box_search, meta["claims"])
+    if model.path_planner is not None:
+        restore_planner(model.path_planner, meta["paths"], meta["lookup"])
+
+    # the restored cells are not changes, clients start from a full
+    # snapshot
+    grid.pop_dirty_cells()
+    model.change_log.clear()
+    return model
+
+
+def restore_agents(model, checkpoint):
+    """
+    Take every agent out of the grid and put it back in its saved cell, in
+    the saved order so the stacks keep their levels
+
+    Args:
+        model (BoxPicking): the new model
+        checkpoint (dict): the NumPy arrays of the checkpoint by name
+
+    Returns:
+        dict: the agents by unique id
+    """
+    grid = model.grid
+    agents = {robot.unique_id: robot for robot in model.schedule.agents}
+    agents.update((box.unique_id, box) for box in model.box_agents)
+    for agent in agents.values():
+        if agent.pos is not None:
+            grid.remove_agent(agent)
+    for unique_id, is_picked, is_placed in checkpoint["boxes"].tolist():
+        agents[unique_id].set_state(bool(is_picked), bool(is_placed))
+    for unique_id, x, y in checkpoint["agents"].tolist():
+        grid.place_agent(agents[unique_id], (x, y))
+    return agents
+
+
+def restore_compact_agents(model, checkpoint):
+    """
+    Take every robot and box out of a model that keeps its boxes in the
+    arrays of the grid and put them back in their saved cells, the boxes of
+    each cell in the saved order
+
+    Args:
+        model (BoxPicking): the new model
+        checkpoint (dict): the NumPy arrays of the checkpoint by name
+
+    Returns:
+        dict: the robots and the carried boxes by unique id
+    """
+    grid = model.grid
+    agents = {robot.unique_id: robot for robot in model.schedule.agents}
+    for robot in agents.values():
+        if robot.pos is not None:
+            grid.remove_agent(robot)
+    grid.clear_boxes()
+    states = {unique_id: PICKED if is_picked else
+              PLACED if is_placed else LOOSE
+              for unique_id, is_picked, is_placed
+              in checkpoint["boxes"].tolist()}
+    for unique_id, x, y in checkpoint["agents"].tolist():
+        if unique_id in agents:
+            grid.place_agent(agents[unique_id], (x, y))
+            continue
+        box = grid.add_box(unique_id, (x, y), states[unique_id])
+        if box is not None:
+            agents[unique_id] = box
+    return agents
+
+
+def restore_claims(box_search, claims):
+    """
+    Replace the claimed box cells of a box search
+
+    Args:
+        box_search (BoxSearch): the box search of the model
+        claims (list): the (robot id, claimed cell) pairs
+    """
+    box_search.claims.clear()
+    box_search.claimed_by.clear()
+    for robot_id, claim in claims:
+        box_search.claims[robot_id] = tuple(claim)
+        box_search.claimed_by[tuple(claim)] = robot_id
+    # the distance field is built again on the next query
+    box_search.version = None
+
+
+def restore_planner(planner, paths, lookup):
+    """
+    Replace the cached paths of a planner
+
+    Args:
+        planner (PathPlanner): the path planner of the model
+        paths (list): the cached paths
+        lookup (list): the (cell, goal, path number, index) entries
+    """
+    planner.paths.clear()
+    planner.lookup.clear()
+    planner.cell_paths.clear()
+    planner.goal_paths.clear()
+    path_ids = []
+    for path in paths:
+        path = tuple(tuple(cell) for cell in path)
+        path_id = next(planner.path_ids)
+        path_ids.append(path_id)
+        planner.paths[path_id] = path
+        planner.goal_paths.setdefault(path[-1], set()).add(path_id)
+        for cell in path:
+            planner.cell_paths.setdefault(cell, set()).add(path_id)
+    for cell, goal, number, index in lookup:
+        planner.lookup[(tuple(cell), tuple(goal))] = (path_ids[number],
+                                                      index)
+
+
+def save_checkpoint(model, path):
+    """
+    Save the checkpoint of a model in a file
+
+    Args:
+        model (BoxPicking): the model
+        path (str or file): where to write the compressed archive
+    """
+    np.savez_compressed(path, **get_checkpoint(model))
+
+
+def read_checkpoint(path):
+    """
+    Read the arrays of a checkpoint file without building its model
+
+    Args:
+        path (str or file): the compressed archive written by
+            save_checkpoint
+
+    Returns:
+        dict: the NumPy arrays of the checkpoint by name
+    """
+    with np.load(path) as archive:
+        return dict(archive)
+
+
+def load_checkpoint(path):
+    """
+    Build the model saved in a file
+
+    Args:
+        path (str or file): the compressed archive written by
+            save_checkpoint
+
+    Returns:
+        BoxPicking: the model
+    """
+    return restore_checkpoint(read_checkpoint(path))
@@ -0,0 +1,85 @@
+"""
+Binary encoding of the agent records sent to the Unity client. Every agent
+is a fixed size little-endian record, so a frame is just the bytes of a
+NumPy structured array and the client can read it without parsing JSON.
+"""
+from itertools import chain
+
+import numpy as np
+
+BINARY_MIMETYPE = "application/octet-stream"
+
+# id, cell coordinates, position of a box in its stack and flags. The level
+# is one byte, a box higher than 255 in its stack is sent at level 255
+FRAME_DTYPE = np.dtype([("id", "<i4"),
+                        ("x", "<u2"),
+                        ("z", "<u2"),
+                        ("level", "u1"),
+                        ("flags", "u1")])
+
+# bits of the flags field
+ROBOT_FLAG = 1
+HAS_BOX_FLAG = 2
+MAX_LEVEL = 255
+
+
+def fill_records(frame, records):
+    """
+    Fill the id, x and z columns of a part of a frame from the records of
+    the model, one column at a time
+
+    Args:
+        frame (numpy.ndarray): the part of the frame
+        records (dict): (x, z, value) records by unique id
+
+    Returns:
+        numpy.ndarray: the third value of every record
+    """
+    frame["id"] = np.fromiter(records.keys(), dtype=np.int64,
+                              count=len(records))
+    values = np.fromiter(chain.from_iterable(records.values()),
+                         dtype=np.int64,
+                         count=3 * len(records)).reshape(-1, 3)
+    frame["x"] = values[:, 0]
+    frame["z"] = values[:, 1]
+    return values[:, 2]
+
+
+def encode_records(robots=None, boxes=None):
+    """
+    Pack robot and box records into a binary frame
+
+    Args:
+        robots (dict): robot records (x, z, has_box) by unique id
+        boxes (dict): box records (x, z, level) by unique id, the levels
+            above MAX_LEVEL are sent as MAX_LEVEL
+
+    Returns:
+        bytes: the packed records, robots first
+    """
+    robots = robots or {}
+    boxes = boxes or {}
+    frame = np.empty(len(robots) + len(boxes), dtype=FRAME_DTYPE)
+    robot_rows = frame[:len(robots)]
+    has_box = fill_records(robot_rows, robots)
+    robot_rows["level"] = 0
+    robot_rows["flags"] = np.where(has_box != 0, ROBOT_FLAG | HAS_BOX_FLAG,
+                                   ROBOT_FLAG)
+    box_rows = frame[len(robots):]
+    level = fill_records(box_rows, boxes)
+    box_rows["level"] = np.minimum(level, MAX_LEVEL)
+    box_rows["flags"] = 0
+    return frame.tobytes()
+
+
+def decode_records(data):
+    """
+    Unpack a binary frame
+
+    Args:
+        data (bytes): the packed records
+
+    Returns:
+        numpy.ndarray: the records as a structured array of FRAME_DTYPE
+    """
+    return np.frombuffer(data, dtype=FRAME_DTYPE)
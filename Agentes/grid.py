@@ -0,0 +1,548 @@
+import numpy as np
+from mesa.space import MultiGrid
+from agent import Robot, Box, LOOSE, PICKED, PLACED
+
+# codes of the box states in the arrays of a CompactOccupancyGrid, -1 is a
+# box that is not in the grid
+STATE_CODES = {LOOSE: 0, PICKED: 1, PLACED: 2}
+
+
+class OccupancyGrid(MultiGrid):
+    """
+    A MultiGrid that mirrors the contents of every cell in NumPy arrays, so
+    the agents can ask how many agents a cell holds, how many boxes it has or
+    which robot is on it with an index lookup instead of building a list
+    """
+
+    def __init__(self, width, height, torus):
+        """
+        Create a new OccupancyGrid.
+
+        Args:
+            width (int): the width of the grid
+            height (int): the height of the grid
+            torus (bool): whether the grid wraps around its edges
+        """
+        super().__init__(width, height, torus)
+        # total number of agents in each cell
+        self.agent_count = np.zeros((width, height), dtype=np.int32)
+        # number of boxes in each cell
+        self.box_count = np.zeros((width, height), dtype=np.int32)
+        # unique id of the robot in each cell, -1 if there is none
+        self.robot_id = np.full((width, height), -1, dtype=np.int64)
+        # cells that are (or were) used to stack boxes
+        self.stacking_mask = np.zeros((width, height), dtype=bool)
+        self._robots = {}
+        # boxes that are neither picked nor placed, by cell
+        self.loose_count = np.zeros((width, height), dtype=np.int32)
+        self._loose_boxes = {}
+        # changes every time a cell gets its first loose box, loses its last
+        # one or becomes a stacking position, so the structures built from
+        # those cells know when to rebuild
+        self.layout_version = 0
+        # functions called with the position of every cell whose layout
+        # changes
+        self.layout_listeners = []
+        # cells whose contents changed since the last call to
+        # pop_dirty_cells
+        self.dirty_cells = set()
+
+    def place_agent(self, agent, pos):
+        """
+        Place the agent at the given position and update the occupancy layer
+
+        Args:
+            agent (Agent): the agent to place
+            pos (tuple): the coordinates of the cell
+        """
+        x, y = pos
+        # MultiGrid ignores agents that are already in the cell, so the
+        # occupancy layer has to do the same
+        if agent.pos is not None and agent in self._grid[x][y]:
+            return
+        super().place_agent(agent, pos)
+        self.dirty_cells.add(pos)
+        self.agent_count[x, y] += 1
+        if isinstance(agent, Robot):
+            self.robot_id[x, y] = agent.unique_id
+            self._robots[agent.unique_id] = agent
+        else:
+            self.box_count[x, y] += 1
+            if agent.get_state() == LOOSE:
+                self._add_loose_box(agent, pos)
+
+    def remove_agent(self, agent):
+        """
+        Remove the agent from the grid and update the occupancy layer
+
+        Args:
+            agent (Agent): the agent to remove
+        """
+        pos = agent.pos
+        x, y = pos
+        self.dirty_cells.add(pos)
+        super().remove_agent(agent)
+        self.agent_count[x, y] -= 1
+        if isinstance(agent, Robot):
+            if self.robot_id[x, y] == agent.unique_id:
+                self.robot_id[x, y] = -1
+        else:
+            self.box_count[x, y] -= 1
+            if agent.get_state() == LOOSE:
+                self._remove_loose_box(agent, pos)
+
+    def _add_loose_box(self, box, pos):
+        self.loose_count[pos[0], pos[1]] += 1
+        self._loose_boxes.setdefault(pos, []).append(box)
+        if self.loose_count[pos[0], pos[1]] == 1:
+            self._layout_changed(pos)
+
+    def _remove_loose_box(self, box, pos):
+        self.loose_count[pos[0], pos[1]] -= 1
+        boxes = self._loose_boxes[pos]
+        boxes.remove(box)
+        if not boxes:
+            del self._loose_boxes[pos]
+        if self.loose_count[pos[0], pos[1]] == 0:
+            self._layout_changed(pos)
+
+    def _layout_changed(self, pos):
+        self.layout_version += 1
+        for listener in self.layout_listeners:
+            listener(pos)
+
+    def update_box_state(self, box, old_state, new_state):
+        """
+        Add or remove a box from the index of loose boxes when it is picked,
+        dropped or placed without leaving its cell
+
+        Args:
+            box (Box): the box that changed its state
+            old_state (str): the previous state of the box
+            new_state (str): the new state of the box
+        """
+        if new_state == LOOSE:
+            self._add_loose_box(box, box.pos)
+        elif old_state == LOOSE:
+            self._remove_loose_box(box, box.pos)
+
+    def place_loose_boxes(self, pos):
+        """
+        Mark every loose box of a cell as placed, used when the cell becomes
+        a stacking position
+
+        Args:
+            pos (tuple): the coordinates of the cell
+        """
+        for box in list(self._loose_boxes.get(pos, ())):
+            box.is_placed_correctly = True
+
+    def iter_box_ids(self, pos):
+        """
+        Yields the unique ids of the boxes of a cell, from the bottom of the
+        stack up
+
+        Args:
+            pos (tuple): the coordinates of the cell
+
+        Yields:
+            int: the unique id of a box
+        """
+        for agent in self._grid[pos[0]][pos[1]]:
+            if not isinstance(agent, Robot):
+                yield agent.unique_id
+
+    def pop_dirty_cells(self):
+        """
+        Returns the cells whose contents changed and starts a new record
+
+        Returns:
+            set: the coordinates of the changed cells
+        """
+        dirty_cells = self.dirty_cells
+        self.dirty_cells = set()
+        return dirty_cells
+
+    def cell_count(self, pos):
+        """
+        Returns the number of agents in a cell
+
+        Args:
+            pos (tuple): the coordinates of the cell
+
+        Returns:
+            int: the number of agents in the cell
+        """
+        return int(self.agent_count[pos[0], pos[1]])
+
+    def boxes_in_cell(self, pos):
+        """
+        Returns the number of boxes in a cell
+
+        Args:
+            pos (tuple): the coordinates of the cell
+
+        Returns:
+            int: the number of boxes in the cell
+        """
+        return int(self.box_count[pos[0], pos[1]])
+
+    def loose_boxes_in_cell(self, pos):
+        """
+        Returns the number of boxes in a cell that are neither picked nor
+        placed
+
+        Args:
+            pos (tuple): the coordinates of the cell
+
+        Returns:
+            int: the number of loose boxes in the cell
+        """
+        return int(self.loose_count[pos[0], pos[1]])
+
+    def get_loose_box(self, pos):
+        """
+        Returns a box of a cell that is neither picked nor placed
+
+        Args:
+            pos (tuple): the coordinates of the cell
+
+        Returns:
+            Box: the first loose box of the cell, None if there is none
+        """
+        boxes = self._loose_boxes.get(pos)
+        if not boxes:
+            return None
+        return boxes[0]
+
+    def is_obstacle(self, pos):
+        """
+        Returns whether a cell blocks the way of the robots no matter where
+        the robots are, because it has a loose box or it is a stacking
+        position
+
+        Args:
+            pos (tuple): the coordinates of the cell
+
+        Returns:
+            bool: True if the cell is an obstacle
+        """
+        return bool(self.loose_count[pos[0], pos[1]] > 0 or
+                    self.stacking_mask[pos[0], pos[1]])
+
+    def has_robot(self, pos):
+        """
+        Returns whether there is a robot in a cell
+
+        Args:
+            pos (tuple): the coordinates of the cell
+
+        Returns:
+            bool: True if there is a robot in the cell
+        """
+        return bool(self.robot_id[pos[0], pos[1]] >= 0)
+
+    def robot_at(self, pos):
+        """
+        Returns the robot in a cell
+
+        Args:
+            pos (tuple): the coordinates of the cell
+
+        Returns:
+            Robot: the robot in the cell, None if there is none
+        """
+        robot_id = self.robot_id[pos[0], pos[1]]
+        if robot_id < 0:
+            return None
+        return self._robots[int(robot_id)]
+
+    def mark_stacking_position(self, pos):
+        """
+        Mark a cell as a stacking position
+
+        Args:
+            pos (tuple): the coordinates of the cell
+        """
+        if not self.stacking_mask[pos[0], pos[1]]:
+            self.stacking_mask[pos[0], pos[1]] = True
+            self._layout_changed(pos)
+
+    def is_stacking_position(self, pos):
+        """
+        Returns whether a cell is a stacking position
+
+        Args:
+            pos (tuple): the coordinates of the cell
+
+        Returns:
+            bool: True if the cell is a stacking position
+        """
+        if self.out_of_bounds(pos):
+            return False
+        return bool(self.stacking_mask[pos[0], pos[1]])
+
+
+class CompactOccupancyGrid(OccupancyGrid):
+    """
+    An OccupancyGrid that keeps the boxes in NumPy arrays instead of Box
+    agents. The boxes of a cell form a stack linked from the bottom up. A
+    box becomes a Box agent when a robot picks it and goes back to the
+    arrays when it is dropped or stacked, so only the robots and the boxes
+    being carried are in the cells of the MultiGrid. The grid methods the
+    agents and the model use work the same as in an OccupancyGrid
+    """
+
+    def __init__(self, width, height, torus, model, n_boxes, first_box_id):
+        """
+        Create a new CompactOccupancyGrid.
+
+        Args:
+            width (int): the width of the grid
+            height (int): the height of the grid
+            torus (bool): whether the grid wraps around its edges
+            model (BoxPicking): the model, which counts the boxes in each
+                state
+            n_boxes (int): the number of boxes
+            first_box_id (int): the unique id of the first box, the boxes
+                have consecutive ids
+        """
+        super().__init__(width, height, torus)
+        self.model = model
+        self.first_box_id = first_box_id
+        # state code of every box, by unique id - first_box_id
+        self.box_state = np.full(n_boxes, -1, dtype=np.int8)
+        # box above every box in its stack, -1 for the top one
+        self.box_above = np.full(n_boxes, -1, dtype=np.int32)
+        # bottom and top box of the stack of every cell, -1 if it is empty
+        self.cell_bottom = np.full((width, height), -1, dtype=np.int32)
+        self.cell_top = np.full((width, height), -1, dtype=np.int32)
+        # the boxes that are agents, by unique id
+        self.box_agents = {}
+
+    def _link(self, index, pos):
+        x, y = pos
+        top = self.cell_top[x, y]
+        if top < 0:
+            self.cell_bottom[x, y] = index
+        else:
+            self.box_above[top] = index
+        self.cell_top[x, y] = index
+        self.box_above[index] = -1
+
+    def _unlink(self, index, pos):
+        x, y = pos
+        below = -1
+        current = self.cell_bottom[x, y]
+        while current != index:
+            below = current
+            current = self.box_above[current]
+        above = self.box_above[index]
+        if below < 0:
+            self.cell_bottom[x, y] = above
+        else:
+            self.box_above[below] = above
+        if self.cell_top[x, y] == index:
+            self.cell_top[x, y] = below
+        self.box_above[index] = -1
+
+    def add_boxes(self, x, y, placed):
+        """
+        Add the first boxes of the model, one in each of the given empty
+        cells. Like the rest of the initial placement, the cells are not
+        recorded as changed
+
+        Args:
+            x (numpy.ndarray): the x coordinates of the cells, all the cells
+                are different
+            y (numpy.ndarray): the y coordinates of the cells
+            placed (numpy.ndarray): whether each box is placed correctly
+        """
+        n_boxes = len(x)
+        if not n_boxes:
+            return
+        indices = np.arange(n_boxes, dtype=np.int32)
+        self.box_state[indices] = np.where(placed, STATE_CODES[PLACED],
+                                           STATE_CODES[LOOSE])
+        self.cell_bottom[x, y] = indices
+        self.cell_top[x, y] = indices
+        self.agent_count[x, y] += 1
+        self.box_count[x, y] += 1
+        self.loose_count[x[~placed], y[~placed]] += 1
+        n_placed = int(np.count_nonzero(placed))
+        self.model.update_box_count(None, PLACED, n_placed)
+        self.model.update_box_count(None, LOOSE, n_boxes - n_placed)
+
+        self.layout_version += 1
+        if self.layout_listeners:
+            for pos in zip(x[~placed].tolist(), y[~placed].tolist()):
+                for listener in self.layout_listeners:
+                    listener(pos)
+
+    def add_box(self, unique_id, pos, state):
+        """
+        Add a box on top of the stack of a cell
+
+        Args:
+            unique_id (int): the unique id of the box
+            pos (tuple): the coordinates of the cell
+            state (str): the state of the box
+
+        Returns:
+            Box: the agent of the box if it is picked, None otherwise
+        """
+        index = unique_id - self.first_box_id
+        self.box_state[index] = STATE_CODES[state]
+        if state == PICKED:
+            box = Box(unique_id, self.model)
+            box.is_picked = True
+            self.box_agents[unique_id] = box
+            self.place_agent(box, pos)
+            return box
+        self.model.update_box_count(None, state)
+        self._link(index, pos)
+        x, y = pos
+        self.dirty_cells.add(pos)
+        self.agent_count[x, y] += 1
+        self.box_count[x, y] += 1
+        if state == LOOSE:
+            self.loose_count[x, y] += 1
+            if self.loose_count[x, y] == 1:
+                self._layout_changed(pos)
+        return None
+
+    def clear_boxes(self):
+        """
+        Take every box out of the grid and out of the counters of the model
+        """
+        for box in list(self.box_agents.values()):
+            self.remove_agent(box)
+            self.model.update_box_count(box.get_state(), None)
+        self.box_agents.clear()
+        for state in (LOOSE, PLACED):
+            self.model.update_box_count(
+                state, None,
+                int(np.count_nonzero(self.box_state == STATE_CODES[state])))
+
+        x, y = np.nonzero(self.box_count)
+        self.dirty_cells.update(zip(x.tolist(), y.tolist()))
+        loose_cells = np.nonzero(self.loose_count)
+        self.agent_count -= self.box_count
+        self.box_count[:] = 0
+        self.loose_count[:] = 0
+        for pos in zip(*(axis.tolist() for axis in loose_cells)):
+            self._layout_changed(pos)
+        self.box_state[:] = -1
+        self.box_above[:] = -1
+        self.cell_bottom[:] = -1
+        self.cell_top[:] = -1
+
+    def update_box_state(self, box, old_state, new_state):
+        """
+        Update the indexes when a box agent changes its state. A box that
+        is dropped or stacked goes back to the arrays, on top of the stack
+        of its cell
+
+        Args:
+            box (Box): the box that changed its state
+            old_state (str): the previous state of the box
+            new_state (str): the new state of the box
+        """
+        super().update_box_state(box, old_state, new_state)
+        if new_state == PICKED:
+            return
+        pos = box.pos
+        if new_state == LOOSE:
+            boxes = self._loose_boxes[pos]
+            boxes.remove(box)
+            if not boxes:
+                del self._loose_boxes[pos]
+        # the box stays counted in its cell
+        MultiGrid.remove_agent(self, box)
+        del self.box_agents[box.unique_id]
+        index = box.unique_id - self.first_box_id
+        self.box_state[index] = STATE_CODES[new_state]
+        self._link(index, pos)
+
+    def get_loose_box(self, pos):
+        """
+        Returns a box of a cell that is neither picked nor placed, as a Box
+        agent in the same cell
+
+        Args:
+            pos (tuple): the coordinates of the cell
+
+        Returns:
+            Box: the lowest loose box of the cell, None if there is none
+        """
+        box = super().get_loose_box(pos)
+        if box is not None or self.loose_count[pos[0], pos[1]] == 0:
+            return box
+        index = self.cell_bottom[pos[0], pos[1]]
+        while self.box_state[index] != STATE_CODES[LOOSE]:
+            index = self.box_above[index]
+        self._unlink(index, pos)
+        self.box_state[index] = STATE_CODES[PICKED]
+        box = Box(self.first_box_id + int(index), self.model, new=False)
+        self.box_agents[box.unique_id] = box
+        # the box is already counted in its cell and as loose
+        MultiGrid.place_agent(self, box, pos)
+        self._loose_boxes.setdefault(pos, []).append(box)
+        return box
+
+    def place_loose_boxes(self, pos):
+        """
+        Mark every loose box of a cell as placed, used when the cell becomes
+        a stacking position
+
+        Args:
+            pos (tuple): the coordinates of the cell
+        """
+        super().place_loose_boxes(pos)
+        x, y = pos
+        placed = 0
+        index = self.cell_bottom[x, y]
+        while index >= 0:
+            if self.box_state[index] == STATE_CODES[LOOSE]:
+                self.box_state[index] = STATE_CODES[PLACED]
+                placed += 1
+            index = self.box_above[index]
+        if placed:
+            self.loose_count[x, y] -= placed
+            self.model.update_box_count(LOOSE, PLACED, placed)
+            if self.loose_count[x, y] == 0:
+                self._layout_changed(pos)
+
+    def iter_box_ids(self, pos):
+        """
+        Yields the unique ids of the boxes of a cell, from the bottom of the
+        stack up. The carried boxes are above the ones in the arrays
+
+        Args:
+            pos (tuple): the coordinates of the cell
+
+        Yields:
+            int: the unique id of a box
+        """
+        index = self.cell_bottom[pos[0], pos[1]]
+        while index >= 0:
+            yield self.first_box_id + int(index)
+            index = self.box_above[index]
+        yield from super().iter_box_ids(pos)
+
+    def get_box_states(self):
+        """
+        Returns the state of every box
+
+        Returns:
+            numpy.ndarray: a row (unique id, is picked, is placed) for every
+                box
+        """
+        states = np.empty((len(self.box_state), 3), dtype=np.int64)
+        states[:, 0] = self.first_box_id + np.arange(len(self.box_state))
+        states[:, 1] = self.box_state == STATE_CODES[PICKED]
+        states[:, 2] = self.box_state == STATE_CODES[PLACED]
+        for unique_id, box in self.box_agents.items():
+            states[unique_id - self.first_box_id, 1:] = (
+                box.is_picked, box.is_placed_correctly)
+        return states
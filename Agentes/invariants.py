@@ -0,0 +1,160 @@
+"""
+Checks of invariants of the BoxPicking model that are easy to break when the
+agents change. The checks are seeded, so they give the same result on every
+machine, and the script exits with an error when one of them fails.
+
+The checkpoint check runs a model, saves it halfway and restores it, then
+steps the original, the restored model and a model that was never saved,
+and compares them after every step, for every combination of activation,
+box search, path planner and box storage.
+
+The field check steps models that use the distance field of the box search
+and compares the field, repaired around the changed cells, with a field
+built from scratch after every step.
+
+Example:
+    python invariants.py
+    python invariants.py --steps 400 --seeds 3
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import sys
+
+import numpy as np
+
+from checkpoint import load_checkpoint, save_checkpoint
+from model import BoxPicking
+from search import build_field
+
+ACTIVATIONS = ("random", "batched", "reservation")
+SEARCHES = ("random", "field")
+PLANNERS = ("greedy", "astar")
+BOX_STORAGES = ("agents", "compact")
+
+
+def get_state(model):
+    """
+    Returns everything a step can change that can be compared
+
+    Args:
+        model (BoxPicking): the model
+
+    Returns:
+        tuple: the steps, the counters and the records of every agent
+    """
+    robots = sorted((robot.unique_id, robot.pos, robot.has_box, robot.zone,
+                     robot.move_random_with_box)
+                    for robot in model.schedule.agents)
+    return (model.schedule.steps, model.running, model.movements,
+            model.placed_boxes, model.stacked_boxes, model.ideal_positions,
+            robots, model.get_snapshot())
+
+
+def check_checkpoint(configuration, seed, steps):
+    """
+    Save a model halfway through its steps, restore it and check the
+    restored model does the same steps as the original and as a model that
+    was never saved
+
+    Args:
+        configuration (dict): the activation, search, planner and
+            box_storage of the model
+        seed (int): the seed of the model
+        steps (int): the number of steps, the model is saved at half
+
+    Returns:
+        int: the first step where the models differ, None if they never do
+    """
+    parameters = dict(configuration, seed=seed, n_robots=12,
+                      stack_height=4)
+    with contextlib.redirect_stdout(io.StringIO()):
+        original = BoxPicking(20, 20, 80, steps, **parameters)
+        unsaved = BoxPicking(20, 20, 80, steps, **parameters)
+        for _ in range(steps // 2):
+            original.step()
+            unsaved.step()
+        data = io.BytesIO()
+        save_checkpoint(original, data)
+        data.seek(0)
+        restored = load_checkpoint(data)
+        models = (original, unsaved, restored)
+        if get_state(restored) != get_state(original):
+            return original.schedule.steps
+        while original.running:
+            for model in models:
+                model.step()
+            state = get_state(original)
+            if get_state(unsaved) != state or get_state(restored) != state:
+                return original.schedule.steps
+    return None
+
+
+def check_field(activation, seed, steps):
+    """
+    Step a model with the distance field and check the repaired field is
+    the field built from scratch after every step
+
+    Args:
+        activation (str): the activation of the model
+        seed (int): the seed of the model
+        steps (int): the maximum number of steps
+
+    Returns:
+        int: the first step where the fields differ, None if they never do
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = BoxPicking(30, 25, 150, steps, seed=seed,
+                           activation=activation, search="field",
+                           n_robots=30,
+                           stacking_zones=[(0, 0, 10, 5), (20, 20, 10, 5)])
+        field = model.box_search
+        grid = model.grid
+        while model.running:
+            model.step()
+            field.update()
+            sources = grid.loose_count > 0
+            distance, nearest = build_field(sources,
+                                            sources | grid.stacking_mask)
+            if not np.array_equal(distance, field.distance) or \
+                    not np.array_equal(nearest, field.nearest):
+                return model.schedule.steps
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check invariants of the BoxPicking model")
+    parser.add_argument("--steps", type=int, default=300,
+                        help="steps of every model")
+    parser.add_argument("--seeds", type=int, default=2,
+                        help="number of seeds of every check")
+    args = parser.parse_args()
+
+    failures = 0
+    for activation, search, planner, box_storage in itertools.product(
+            ACTIVATIONS, SEARCHES, PLANNERS, BOX_STORAGES):
+        configuration = {"activation": activation, "search": search,
+                         "planner": planner, "box_storage": box_storage}
+        for seed in range(args.seeds):
+            step = check_checkpoint(configuration, seed, args.steps)
+            failures += step is not None
+            print(f"checkpoint {activation} {search} {planner} "
+                  f"{box_storage} seed {seed}: "
+                  f"{'ok' if step is None else f'differs at step {step}'}")
+    for activation in ACTIVATIONS:
+        for seed in range(args.seeds):
+            step = check_field(activation, seed, args.steps)
+            failures += step is not None
+            print(f"field {activation} seed {seed}: "
+                  f"{'ok' if step is None else f'differs at step {step}'}")
+
+    if failures:
+        print(f"{failures} checks failed")
+        sys.exit(1)
+    print("every check passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,33 @@
+from collections import deque
+
+import numpy as np
 from mesa import Model
-from mesa.space import MultiGrid
 from mesa.datacollection import DataCollector
 from mesa.time import RandomActivation
-from agent import Robot, Box
+from agent import Robot, Box, LOOSE, PICKED, PLACED
+from grid import OccupancyGrid, CompactOccupancyGrid
+from schedule import BatchedActivation, ReservationActivation
+from reservation import ReservationTable
+from search import BoxSearch
+from pathfinding import PathPlanner
+from profiling import Profiler, get_reporters
+from stacking import StackingAllocator
+from streaming import StalledRobots, StreamingCollector
+from recording import TraceWriter
+
+# unique ids of the first robot and the first box
+FIRST_ROBOT_ID = 10000
+FIRST_BOX_ID = 20000
+# ways the model can keep its boxes
+BOX_STORAGES = ("agents", "compact")
 
 
 class BoxPicking(Model):
-    def __init__(self, width, height, n_boxes, max_steps):
+    def __init__(self, width, height, n_boxes, max_steps, seed=None,
+                 change_log_size=1000, activation="random", n_robots=5,
+                 search="random", planner="greedy", stack_height=5,
+                 stacking_zones=None, profile=False, box_storage="agents",
+                 profile_queries=False):
         """
         Create a new BoxPicking model, where it will include Robot agents 
         and Box agents.
@@ -15,63 +36,414 @@ class BoxPicking(Model):
             width (int): the width of the multigrid
             height (int): The height of the multigrid
             n_boxes (int): The number of boxes in the model
+            max_steps (int): The maximum number of steps of the simulation
+            seed (int): seed of the model random number generator, every
+                random choice of the model uses it, so two models with the
+                same parameters and seed do the same steps
+            change_log_size (int): number of steps whose changes are kept
+            activation (str): "random" to step the robots one by one,
+                "batched" to move the robots without a box all at once or
+                "reservation" to plan the moves of all the robots in a
+                reservation table and then do them
+            n_robots (int): The number of robots in the model
+            search (str): how the robots without a box look for one,
+                "random" to walk randomly or "field" to follow the distance
+                field to the nearest unclaimed box
+            planner (str): how the robots carrying a box reach the ideal
+                position, "greedy" to walk along x and then y or "astar" to
+                follow a planned path
+            stack_height (int): the number of boxes of a full stack
+            stacking_zones (list): the rectangles (x, y, width, height)
+                where the boxes are stacked, each zone fills its cells row
+                by row from its bottom left cell. None uses the whole grid
+                as one zone
+            profile (bool): measure the phases of the steps and count the
+                collisions and forced moves. The DataCollector collects the
+                measures when the model stops, or every step when the data
+                is streamed
+            box_storage (str): "agents" to make every box a Box agent or
+                "compact" to keep the boxes in NumPy arrays of the grid,
+                only the boxes being carried are agents and the box_agents
+                list is empty
+            profile_queries (bool): with profile, also count the grid
+                queries, which slows down every query
         """
+        # mesa only reads the seed when it is given by name
+        if seed is not None:
+            self.reset_randomizer(seed)
+        self.seed = seed
         self.width = width
         self.height = height
         self.number_of_boxes = n_boxes
+        self.number_of_robots = n_robots
         self.max_steps = max_steps
         self.movements = 0
+        # boxes a robot stacked, the placed boxes without the ones that were
+        # already in a cell when it became a stacking position
+        self.stacked_boxes = 0
 
         self.box_agents = []
-        self.ideal_position = (0, 0)
-        self.all_stacking_positions = [self.ideal_position]
+        # number of boxes in each state, updated by the boxes themselves
+        self.box_counts = {LOOSE: 0, PICKED: 0, PLACED: 0}
+        self.stack_height = stack_height
+        if stacking_zones is None:
+            stacking_zones = [(0, 0, width, height)]
+        check_stacking_zones(stacking_zones, width, height)
+        self.stacking_zones = [tuple(zone) for zone in stacking_zones]
+        self.activation = activation
+        self.search = search
+        self.planner = planner
+        self.box_storage = box_storage
+        # current stacking position of each zone
+        self.ideal_positions = [(x, y) for x, y, _, _ in stacking_zones]
+        # set of every position used to stack boxes, and the allocator of
+        # each zone that gives the next one when the current stack is full
+        self.all_stacking_positions = set()
+        self.stacking_allocators = [
+            StackingAllocator(zone_width, zone_height, (x, y), (x, y))
+            for x, y, zone_width, zone_height in stacking_zones]
+        # number of robots carrying a box to each zone
+        self.zone_robots = [0] * len(stacking_zones)
 
-        self.schedule = RandomActivation(self)
-        self.grid = MultiGrid(width, height, False)
+        if activation == "batched":
+            self.schedule = BatchedActivation(self)
+        elif activation == "reservation":
+            self.schedule = ReservationActivation(self)
+        elif activation == "random":
+            self.schedule = RandomActivation(self)
+        else:
+            raise ValueError(f"Unknown activation: {activation}")
+        # MultiGrid with a NumPy occupancy layer for O(1) cell queries
+        if box_storage == "compact":
+            self.grid = CompactOccupancyGrid(width, height, False, self,
+                                             n_boxes, FIRST_BOX_ID)
+        elif box_storage == "agents":
+            self.grid = OccupancyGrid(width, height, False)
+        else:
+            raise ValueError(f"Unknown box storage: {box_storage}")
+        # cells the robots will be in on the next step
+        self.reservations = None
+        if activation == "reservation":
+            self.reservations = ReservationTable(self.grid)
+        for position in self.ideal_positions:
+            self.add_stacking_position(position)
         self.running = True
+        if search == "field":
+            self.box_search = BoxSearch(self)
+        elif search == "random":
+            self.box_search = None
+        else:
+            raise ValueError(f"Unknown search: {search}")
+        if planner == "astar":
+            self.path_planner = PathPlanner(self)
+        elif planner == "greedy":
+            self.path_planner = None
+        else:
+            raise ValueError(f"Unknown planner: {planner}")
+        # changes of the last steps, each entry is (step, robots, boxes)
+        self.change_log = deque(maxlen=change_log_size)
 
-        # Collect data about movements across all agents
-        self.datacollector = DataCollector(
-            {
-                "movements": BoxPicking.get_movements
-            }
-        )
-
-        for i in range(n_boxes):
-            box = Box(i + 20000, self)
-            # move box to random empty position
-            empty_coordinates = self.grid.find_empty()
-            self.grid.place_agent(box, empty_coordinates)
-            # if the position where the box is placed is the ideal position, s
-            # et the instance variable to True
-            if box.pos[0] == self.ideal_position[0] and box.pos[1] \
-                    == self.ideal_position[1]:
-                box.is_placed_correctly = True
-            self.box_agents.append(box)
-
-        for i in range(5):
-            robot = Robot(i + 10000, self)
-            self.schedule.add(robot)
-            # Get the coordinates for an empty cell
-            empty_coordinates = self.grid.find_empty()
+        # one random sample of distinct cells gives every agent its own
+        # empty cell in a single pass, the boxes take the first cells and
+        # the robots the next ones that are not an ideal position
+        n_cells = width * height
+        if n_boxes > n_cells:
+            raise ValueError("There are more boxes than cells")
+        sample_size = min(n_cells,
+                          n_boxes + n_robots + len(self.ideal_positions))
+        sample = self.random.sample(range(n_cells), sample_size)
+        empty_cells = (divmod(index, height) for index in sample)
+
+        if box_storage == "compact":
+            # the cells of the boxes as arrays, a list of tuples of a
+            # million cells would take more memory than the grid
+            x, y = np.divmod(np.array(sample[:n_boxes], dtype=np.int64),
+                             height)
+            placed = np.zeros(n_boxes, dtype=bool)
+            for ideal_x, ideal_y in self.ideal_positions:
+                placed |= (x == ideal_x) & (y == ideal_y)
+            self.grid.add_boxes(x, y, placed)
+            empty_cells = (divmod(index, height)
+                           for index in sample[n_boxes:])
+        else:
+            for i in range(n_boxes):
+                box = Box(i + FIRST_BOX_ID, self)
+                self.grid.place_agent(box, next(empty_cells))
+                # if the position where the box is placed is an ideal
+                # position, set the instance variable to True
+                if box.pos in self.ideal_positions:
+                    box.is_placed_correctly = True
+                self.box_agents.append(box)
+
+        robot_cells = (position for position in empty_cells
+                       if position not in self.ideal_positions)
+        for i in range(n_robots):
+            empty_coordinates = next(robot_cells, None)
             # If there are no more empty cells, stop adding robots
             if empty_coordinates is None:
                 break
-            # while the coordinates for the empty position are the ideal 
-            # position, get another random empty position 
-            while empty_coordinates[0] == self.ideal_position[0] and \
-                    empty_coordinates[1] == self.ideal_position[1]:
-                empty_coordinates = self.grid.find_empty()
-                if empty_coordinates is None:
-                    break
+            robot = Robot(i + FIRST_ROBOT_ID, self)
+            self.schedule.add(robot)
             self.grid.place_agent(robot, empty_coordinates)
 
+        # the initial placement is not a change, clients start from a
+        # full snapshot
+        self.grid.pop_dirty_cells()
+        # created last so it can instrument every agent
+        self.profiler = Profiler(self, profile_queries) if profile \
+            else None
+
+        # Collect data about movements across all agents, every step when
+        # streaming the data to disk
+        self.stalled_robots = StalledRobots(self)
+        self.model_reporters = {
+            "movements": BoxPicking.get_movements,
+            "placed_boxes": BoxPicking.get_number_of_placed_boxes,
+            "stacked_boxes": BoxPicking.get_number_of_stacked_boxes,
+            "picked_boxes": BoxPicking.get_number_of_picked_boxes,
+            "loose_boxes": BoxPicking.get_number_of_loose_boxes,
+            "stalled_robots": BoxPicking.get_number_of_stalled_robots
+        }
+        if profile:
+            self.model_reporters.update(get_reporters(profile_queries))
+        self.datacollector = DataCollector(self.model_reporters)
+        self.collect_data = False
+        self.trace_writer = None
+
     def step(self):
         self.schedule.step()
-        if (self.get_number_of_placed_boxes() == self.number_of_boxes or 
+        self.record_changes()
+        if self.collect_data:
+            self.datacollector.collect(self)
+        if (self.placed_boxes == self.number_of_boxes or 
                 self.schedule.steps == self.max_steps - 1):
             self.running = False
+            if isinstance(self.datacollector, StreamingCollector):
+                self.datacollector.flush()
+            elif self.profiler is not None:
+                # the totals of the profiler, without a row per step
+                self.datacollector.collect(self)
             self.print_data()
+        if self.trace_writer is not None:
+            self.trace_writer.write_step(self)
+            if not self.running:
+                self.trace_writer.close()
+
+    def stream_data(self, path, chunk_size=1000, file_format="csv",
+                    agents=False):
+        """
+        Replace the DataCollector with a StreamingCollector that writes the
+        model reporters of every step to disk in chunks, so the memory does
+        not grow with the number of steps
+
+        Args:
+            path (str): the directory where the data is written
+            chunk_size (int): the number of rows kept in memory per table
+            file_format (str): "csv" or "npy"
+            agents (bool): also write the position of every robot and
+                whether it carries a box on every step
+        """
+        agent_reporters = None
+        if agents:
+            agent_reporters = {
+                "x": lambda robot: robot.pos[0],
+                "y": lambda robot: robot.pos[1],
+                "has_box": lambda robot: robot.has_box
+            }
+        self.datacollector = StreamingCollector(
+            path, self.model_reporters, agent_reporters, chunk_size,
+            file_format)
+        self.collect_data = True
+
+    def record_trace(self, path, keyframe_interval=100):
+        """
+        Write the agents of the current step and of every step after it to
+        a trace file, that can be replayed without running the model
+
+        Args:
+            path (str): the path of the trace file
+            keyframe_interval (int): the number of steps between the
+                records with every agent
+        """
+        self.trace_writer = TraceWriter(path, self, keyframe_interval)
+
+    def add_stacking_position(self, position):
+        """
+        Register a position as a stacking position, so robots avoid it
+
+        Args:
+            position (tuple): the coordinates of the stacking position
+        """
+        self.all_stacking_positions.add(position)
+        self.grid.mark_stacking_position(position)
+
+    def update_ideal_positions(self):
+        """
+        Move the ideal position of every zone whose stack is full
+        """
+        for zone, position in enumerate(self.ideal_positions):
+            if self.grid.cell_count(position) >= self.stack_height:
+                self.advance_ideal_position(zone)
+
+    def advance_ideal_position(self, zone=0):
+        """
+        Move the ideal position of a zone to the next cell given by its
+        stacking allocator. The loose boxes already in that cell are counted
+        as placed, as when the boxes are placed at the start, but not as
+        stacked_boxes. A cell with a
+        robot in it, or whose stack would shut in a robot next to it, is
+        deferred. If the zone has no more cells, the ideal position stays
+        the same
+
+        Args:
+            zone (int): the index of the zone
+        """
+        allocator = self.stacking_allocators[zone]
+        deferred = []
+        position = allocator.advance()
+        # works as a failsafe in case there is a robot in the next to
+        # be ideal position
+        while position is not None:
+            # a cell reserved by a robot will not be free on the next step
+            if self.grid.has_robot(position) or \
+                    (self.reservations is not None and
+                     self.reservations.is_reserved(position)) or \
+                    self.shuts_in_robot(position):
+                deferred.append(position)
+                position = allocator.advance()
+                continue
+            self.add_stacking_position(position)
+            # otherwise the loose boxes would be shut in by the stacks
+            self.grid.place_loose_boxes(position)
+            if self.grid.cell_count(position) < self.stack_height:
+                if self.path_planner is not None:
+                    self.path_planner.drop_goal(self.ideal_positions[zone])
+                self.ideal_positions[zone] = position
+                break
+            position = allocator.advance()
+        allocator.defer(deferred)
+
+    def shuts_in_robot(self, position):
+        """
+        Returns whether stacking boxes in a cell would leave a robot next to
+        it surrounded by stacking positions
+
+        Args:
+            position (tuple): the coordinates of the cell
+
+        Returns:
+            bool: True if a neighbor robot would have no way out
+        """
+        for neighboor in self.grid.iter_neighborhood(
+                position, moore=False, include_center=False):
+            if not self.grid.has_robot(neighboor):
+                continue
+            if all(cell == position or self.grid.is_stacking_position(cell)
+                   for cell in self.grid.iter_neighborhood(
+                       neighboor, moore=False, include_center=False)):
+                return True
+        return False
+
+    def assign_zone(self, robot):
+        """
+        Send a robot that picked a box to the nearest zone whose current
+        stack has room for it, counting the boxes the robots already going
+        there carry. If every stack is full, the nearest zone is used
+
+        Args:
+            robot (Robot): the robot carrying a box
+        """
+        best_zone = None
+        best_key = None
+        for zone, position in enumerate(self.ideal_positions):
+            room = self.stack_height - self.grid.cell_count(position) - \
+                self.zone_robots[zone]
+            distance = abs(position[0] - robot.pos[0]) + \
+                abs(position[1] - robot.pos[1])
+            key = (room <= 0, distance)
+            if best_key is None or key < best_key:
+                best_zone = zone
+                best_key = key
+        robot.zone = best_zone
+        self.zone_robots[best_zone] += 1
+
+    def release_zone(self, robot):
+        """
+        Forget the zone of a robot that left its box
+
+        Args:
+            robot (Robot): the robot
+        """
+        if robot.zone is not None:
+            self.zone_robots[robot.zone] -= 1
+            robot.zone = None
+
+    def get_cell_records(self, position, robots, boxes):
+        """
+        Add the records of the agents in a cell. A robot record is
+        (x, y, has_box) and a box record is (x, y, level), where level is
+        the position of the box in the stack of the cell
+
+        Args:
+            position (tuple): the coordinates of the cell
+            robots (dict): the robot records by unique id
+            boxes (dict): the box records by unique id
+        """
+        robot = self.grid.robot_at(position)
+        if robot is not None:
+            robots[robot.unique_id] = (position[0], position[1],
+                                       robot.has_box)
+        for level, unique_id in enumerate(self.grid.iter_box_ids(position)):
+            boxes[unique_id] = (position[0], position[1], level)
+
+    def record_changes(self):
+        """
+        Save in the change log the agents of every cell that changed during
+        the step
+        """
+        robots = {}
+        boxes = {}
+        for position in self.grid.pop_dirty_cells():
+            self.get_cell_records(position, robots, boxes)
+        self.change_log.append((self.schedule.steps, robots, boxes))
+
+    def get_snapshot(self):
+        """
+        Returns the records of every agent in the grid
+
+        Returns:
+            tuple: the robot records and the box records by unique id
+        """
+        robots = {}
+        boxes = {}
+        x, y = np.nonzero(self.grid.agent_count)
+        for position in zip(x.tolist(), y.tolist()):
+            self.get_cell_records(position, robots, boxes)
+        return robots, boxes
+
+    def get_changes_since(self, step):
+        """
+        Returns the latest records of the agents that changed after the
+        given step
+
+        Args:
+            step (int): the last step the caller knows
+
+        Returns:
+            tuple: the robot records and the box records by unique id, or
+                None if the change log does not go back to that step
+        """
+        robots = {}
+        boxes = {}
+        if step >= self.schedule.steps:
+            return robots, boxes
+        if not self.change_log or self.change_log[0][0] > step + 1:
+            return None
+        for logged_step, step_robots, step_boxes in self.change_log:
+            if logged_step > step:
+                robots.update(step_robots)
+                boxes.update(step_boxes)
+        return robots, boxes
 
     def get_last_x_position(self):
         """
@@ -91,6 +463,47 @@ class BoxPicking(Model):
         """
         return self.height - 1
 
+    def update_box_count(self, old_state, new_state, number=1):
+        """
+        Update the box counters when a box changes its state
+
+        Args:
+            old_state (str): the previous state of the box, None if the box
+                was just created
+            new_state (str): the new state of the box, None if the box was
+                taken out of the grid
+            number (int): the number of boxes that changed
+        """
+        if old_state == new_state:
+            return
+        if old_state is not None:
+            self.box_counts[old_state] -= number
+        if new_state is not None:
+            self.box_counts[new_state] += number
+
+    @property
+    def placed_boxes(self):
+        """
+        The number of boxes stacked in a stacking position, kept up to date
+        by the boxes
+        """
+        return self.box_counts[PLACED]
+
+    @property
+    def picked_boxes(self):
+        """
+        The number of boxes carried by a robot, kept up to date by the boxes
+        """
+        return self.box_counts[PICKED]
+
+    @property
+    def loose_boxes(self):
+        """
+        The number of boxes that are neither picked nor placed, kept up to
+        date by the boxes
+        """
+        return self.box_counts[LOOSE]
+
     def get_number_of_placed_boxes(self):
         """
         Returns the number of placed boxes in the model
@@ -98,11 +511,56 @@ class BoxPicking(Model):
         Returns:
             int: The number of placed boxes in the model
         """
-        placed_boxes = 0
-        for agent in self.box_agents:
-            if agent.is_placed_correctly:
-                placed_boxes += 1
-        return placed_boxes
+        return self.placed_boxes
+
+    def get_number_of_stacked_boxes(self):
+        """
+        Returns the number of boxes stacked by a robot, the placed boxes
+        that were not counted as placed because they already were in a
+        stacking position
+
+        Returns:
+            int: The number of boxes stacked by a robot
+        """
+        return self.stacked_boxes
+
+    def get_number_of_picked_boxes(self):
+        """
+        Returns the number of boxes carried by a robot
+
+        Returns:
+            int: The number of boxes carried by a robot
+        """
+        return self.picked_boxes
+
+    def get_number_of_loose_boxes(self):
+        """
+        Returns the number of boxes that are neither picked nor placed
+
+        Returns:
+            int: The number of loose boxes in the model
+        """
+        return self.loose_boxes
+
+    def record_collisions(self, count=1):
+        """
+        Called when robots could not move because another robot was in the
+        way or wanted the same cell, or no neighbor cell was free. Does
+        nothing, the profiler counts the collisions when the model has one
+
+        Args:
+            count (int): the number of robots that collided
+        """
+
+    def get_number_of_stalled_robots(self):
+        """
+        Returns the number of robots that did not move nor pick or leave a
+        box since the last time the data was collected
+
+        Returns:
+            int: The number of stalled robots
+        """
+        return self.stalled_robots(self)
 
     def get_movements(self):
         """
@@ -120,3 +578,25 @@ class BoxPicking(Model):
         print("Number of steps (time) to finalization: " +
               str(self.schedule.steps))
         print("Number of movements across all agents: " + str(self.movements))
+
+
+def check_stacking_zones(zones, width, height):
+    """
+    Raise a ValueError if a stacking zone is empty, goes out of the grid or
+    shares cells with another zone
+
+    Args:
+        zones (list): the rectangles (x, y, width, height) of the zones
+        width (int): the width of the grid
+        height (int): the height of the grid
+    """
+    if not zones:
+        raise ValueError("There must be at least one stacking zone")
+    for index, (x, y, zone_width, zone_height) in enumerate(zones):
+        if zone_width <= 0 or zone_height <= 0 or x < 0 or y < 0 or \
+                x + zone_width > width or y + zone_height > height:
+            raise ValueError(f"Stacking zone {index} is not inside the grid")
+        for other_x, other_y, other_width, other_height in zones[:index]:
+            if x < other_x + other_width and other_x < x + zone_width and \
+                    y < other_y + other_height and other_y < y + zone_height:
+                raise ValueError(f"Stacking zone {index} overlaps another")
@@ -0,0 +1,163 @@
+import heapq
+import itertools
+
+
+class PathPlanner:
+    """
+    Plans the way of the robots carrying a box with A* over the cells that
+    are not obstacles (loose boxes and stacking positions). Robots are not
+    obstacles because they move, the robot checks the next cell before
+    moving. Every planned path is cached for each of its cells, so a robot
+    that follows it does not plan again, and a path is dropped only when
+    one of its cells changes
+    """
+
+    def __init__(self, model):
+        """
+        Create a new PathPlanner.
+
+        Args:
+            model (Model): the model the planner belongs to
+        """
+        self.model = model
+        self.paths = {}
+        # (cell, goal) -> (path id, index of the cell in the path)
+        self.lookup = {}
+        # cell -> ids of the cached paths that go through it
+        self.cell_paths = {}
+        # goal -> ids of the cached paths that end on it
+        self.goal_paths = {}
+        self.path_ids = itertools.count()
+        model.grid.layout_listeners.append(self.invalidate_cell)
+
+    def get_path(self, start, goal, blocked=None):
+        """
+        Returns a path from start to goal. The goal can be an obstacle, the
+        path ends on it
+
+        Args:
+            start (tuple): the first cell
+            goal (tuple): the last cell
+            blocked (set): cells that can not be used besides the
+                obstacles, a path planned with them is not cached
+
+        Returns:
+            tuple: the path and the index of start in it, or None if there
+                is no path
+        """
+        if not blocked:
+            cached = self.lookup.get((start, goal))
+            if cached is not None:
+                path_id, index = cached
+                return self.paths[path_id], index
+
+        path = self.plan(start, goal, blocked or set())
+        if path is None:
+            return None
+        if not blocked:
+            self.cache(path, goal)
+        return path, 0
+
+    def plan(self, start, goal, blocked):
+        """
+        A* search with the Manhattan distance as heuristic
+
+        Args:
+            start (tuple): the first cell
+            goal (tuple): the last cell
+            blocked (set): cells that can not be used besides the obstacles
+
+        Returns:
+            tuple: the cells of the path, None if there is no path
+        """
+        grid = self.model.grid
+
+        def heuristic(cell):
+            return abs(cell[0] - goal[0]) + abs(cell[1] - goal[1])
+
+        came_from = {start: None}
+        cost = {start: 0}
+        # the counter keeps the order of cells with the same priority
+        counter = itertools.count()
+        queue = [(heuristic(start), next(counter), start)]
+        while queue:
+            _, _, cell = heapq.heappop(queue)
+            if cell == goal:
+                path = []
+                while cell is not None:
+                    path.append(cell)
+                    cell = came_from[cell]
+                return tuple(reversed(path))
+
+            for neighboor in grid.iter_neighborhood(
+                    cell, moore=False, include_center=False):
+                if neighboor != goal and (neighboor in blocked or
+                                          grid.is_obstacle(neighboor)):
+                    continue
+                new_cost = cost[cell] + 1
+                if new_cost < cost.get(neighboor, new_cost + 1):
+                    cost[neighboor] = new_cost
+                    came_from[neighboor] = cell
+                    heapq.heappush(queue, (new_cost + heuristic(neighboor),
+                                           next(counter), neighboor))
+        return None
+
+    def cache(self, path, goal):
+        """
+        Save a path so every cell of it can find it
+
+        Args:
+            path (tuple): the cells of the path
+            goal (tuple): the last cell of the path
+        """
+        path_id = next(self.path_ids)
+        self.paths[path_id] = path
+        self.goal_paths.setdefault(goal, set()).add(path_id)
+        for index, cell in enumerate(path):
+            self.cell_paths.setdefault(cell, set()).add(path_id)
+            if cell != goal:
+                self.lookup[(cell, goal)] = (path_id, index)
+
+    def invalidate_cell(self, pos):
+        """
+        Drop the cached paths that go through a cell whose layout changed
+
+        Args:
+            pos (tuple): the coordinates of the cell
+        """
+        for path_id in list(self.cell_paths.get(pos, ())):
+            self.drop_path(path_id)
+
+    def drop_goal(self, goal):
+        """
+        Drop the cached paths to a goal that is not used anymore
+
+        Args:
+            goal (tuple): the coordinates of the goal
+        """
+        for path_id in list(self.goal_paths.get(goal, ())):
+            self.drop_path(path_id)
+
+    def drop_path(self, path_id):
+        """
+        Remove a path from the cache
+
+        Args:
+            path_id (int): the id of the path
+        """
+        path = self.paths.pop(path_id, None)
+        if path is None:
+            return
+        goal = path[-1]
+        goal_paths = self.goal_paths[goal]
+        goal_paths.discard(path_id)
+        if not goal_paths:
+            del self.goal_paths[goal]
+        for cell in path:
+            if self.lookup.get((cell, goal), (None,))[0] == path_id:
+                del self.lookup[(cell, goal)]
+            path_ids = self.cell_paths.get(cell)
+            if path_ids is not None:
+                path_ids.discard(path_id)
+                if not path_ids:
+                    del self.cell_paths[cell]
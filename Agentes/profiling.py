@@ -0,0 +1,205 @@
+"""
+Instrumentation of a BoxPicking model to find out where the time of a step
+goes. The profiler wraps the methods of the robots, the grid and the
+scheduler of one model, so a model without a profiler runs the original
+methods and pays nothing.
+"""
+import time
+from functools import wraps
+
+# methods of the robots whose time is measured, the time of a method
+# includes the time of the measured methods it calls
+ROBOT_TIMERS = ("update_ideal_position", "move_randomly",
+                "move_to_ideal_position", "pick_box", "move_to_box")
+# methods of the grid counted as queries, only when asked for because
+# wrapping them slows down every query
+GRID_QUERIES = ("cell_count", "boxes_in_cell", "loose_boxes_in_cell",
+                "get_loose_box", "is_obstacle", "has_robot", "robot_at",
+                "is_stacking_position", "out_of_bounds", "iter_neighborhood",
+                "get_neighborhood")
+COUNTERS = ("collisions", "forced_moves")
+
+
+class Profiler:
+    """
+    Measures the time of the phases of a step and counts the collisions,
+    the forced random moves with a box and, if asked for, the grid queries.
+    A collision is a robot that could not take the cell it wanted because
+    another robot is in it or reserved it, or that found no free cell
+    around it. Every activation reports them through
+    BoxPicking.record_collisions, and the reservation activation counts the
+    cells its table refused
+    """
+
+    def __init__(self, model, count_queries=False):
+        """
+        Create a new Profiler and instrument the model.
+
+        Args:
+            model (BoxPicking): the model to measure, with its agents
+                already created
+            count_queries (bool): also count the grid queries
+        """
+        self.model = model
+        self.count_queries = count_queries
+        # total seconds and number of calls of each timed phase
+        self.times = dict.fromkeys(ROBOT_TIMERS + ("step",), 0.0)
+        self.calls = dict.fromkeys(ROBOT_TIMERS + ("step",), 0)
+        self.counters = dict.fromkeys(get_counters(count_queries), 0)
+        self.instrument()
+
+    def instrument(self):
+        """
+        Replace the measured methods of the model objects with wrappers
+        """
+        model = self.model
+        for robot in model.schedule.agents:
+            for name in ROBOT_TIMERS:
+                setattr(robot, name, self.timed(name, getattr(robot, name)))
+            robot.move_randomly_with_box = self.counted(
+                "forced_moves", robot.move_randomly_with_box)
+        if self.count_queries:
+            for name in GRID_QUERIES:
+                setattr(model.grid, name, self.counted(
+                    "grid_queries", getattr(model.grid, name)))
+        model.record_collisions = self.added(
+            "collisions", model.record_collisions)
+        if model.reservations is not None:
+            model.reservations.can_reserve = self.refused(
+                "collisions", model.reservations.can_reserve)
+        model.schedule.step = self.timed("step", model.schedule.step)
+
+    def timed(self, name, method):
+        """
+        Returns a wrapper of a method that adds its time to a phase
+
+        Args:
+            name (str): the name of the phase
+            method (callable): the bound method
+
+        Returns:
+            callable: the wrapper
+        """
+        times = self.times
+        calls = self.calls
+
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                times[name] += time.perf_counter() - start
+                calls[name] += 1
+        return wrapper
+
+    def counted(self, name, method):
+        """
+        Returns a wrapper of a method that counts its calls
+
+        Args:
+            name (str): the name of the counter
+            method (callable): the bound method
+
+        Returns:
+            callable: the wrapper
+        """
+        counters = self.counters
+
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            counters[name] += 1
+            return method(*args, **kwargs)
+        return wrapper
+
+    def added(self, name, method):
+        """
+        Returns a wrapper of a method that adds its count argument to a
+        counter
+
+        Args:
+            name (str): the name of the counter
+            method (callable): the bound method, called with the count
+
+        Returns:
+            callable: the wrapper
+        """
+        counters = self.counters
+
+        @wraps(method)
+        def wrapper(count=1):
+            counters[name] += count
+            return method(count)
+        return wrapper
+
+    def refused(self, name, method):
+        """
+        Returns a wrapper of a method that counts the calls that return
+        False
+
+        Args:
+            name (str): the name of the counter
+            method (callable): the bound method
+
+        Returns:
+            callable: the wrapper
+        """
+        counters = self.counters
+
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            result = method(*args, **kwargs)
+            if not result:
+                counters[name] += 1
+            return result
+        return wrapper
+
+    def get_metrics(self):
+        """
+        Returns the measures taken so far
+
+        Returns:
+            dict: the seconds, calls and mean seconds of every phase by
+                name and the counters by name
+        """
+        timers = {}
+        for name, total in self.times.items():
+            calls = self.calls[name]
+            timers[name] = {"seconds": total,
+                            "calls": calls,
+                            "mean": total / calls if calls else 0.0}
+        return {"timers": timers, "counters": dict(self.counters)}
+
+
+def get_counters(count_queries=False):
+    """
+    Returns the names of the counters of a profiler
+
+    Args:
+        count_queries (bool): whether the profiler counts the grid queries
+
+    Returns:
+        tuple: the names
+    """
+    return COUNTERS + ("grid_queries",) if count_queries else COUNTERS
+
+
+def get_reporters(count_queries=False):
+    """
+    Returns the DataCollector model reporters of the profiler, the total
+    seconds of every phase and the value of every counter
+
+    Args:
+        count_queries (bool): whether the profiler counts the grid queries
+
+    Returns:
+        dict: the reporters by column name
+    """
+    reporters = {}
+    for name in ROBOT_TIMERS + ("step",):
+        reporters[f"seconds_{name}"] = \
+            lambda model, name=name: model.profiler.times[name]
+    for name in get_counters(count_queries):
+        reporters[name] = \
+            lambda model, name=name: model.profiler.counters[name]
+    return reporters
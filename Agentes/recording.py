@@ -0,0 +1,282 @@
+"""
+Trace files of BoxPicking runs. A trace keeps every step of a run, so it can
+be watched again, shared or scrubbed through without running the model.
+
+A trace is two append-only files. The data file starts with a header with
+the parameters of the run and then has a record per step: the step, whether
+the model was running, the ideal position of every zone and the agent
+records of the binary frames in encoding. Every few steps a keyframe record
+has every agent, the records in between only have the agents that changed.
+The index file has the offset of every record and the keyframe it starts
+from, so any step is found without reading the ones before its keyframe.
+The index entries are only written after the data of their records is
+flushed, so a reader of a trace being written never finds an entry without
+its record. The reader memory-maps both files.
+
+Example:
+    model.record_trace("run.trace")
+    while model.running:
+        model.step()
+    trace = TraceReader("run.trace")
+    frame = trace.get_frame(150)
+"""
+import json
+import os
+import threading
+
+import numpy as np
+
+from encoding import FRAME_DTYPE, encode_records
+
+MAGIC = b"BOXTRACE"
+FORMAT_VERSION = 1
+# step, whether the model was running, whether the record is a keyframe and
+# the number of agent records
+RECORD_DTYPE = np.dtype([("step", "<i4"),
+                         ("running", "u1"),
+                         ("full", "u1"),
+                         ("count", "<u4")])
+# offset of the record in the data file and number of its keyframe
+INDEX_DTYPE = np.dtype([("offset", "<i8"),
+                        ("keyframe", "<i4")])
+# ideal position of a zone
+IDEAL_DTYPE = np.dtype("<u2")
+
+
+class TraceError(Exception):
+    """
+    Raised when a file is not a trace or does not have a step
+    """
+
+
+def index_path(path):
+    return path + ".idx"
+
+
+class TraceWriter:
+    """
+    Appends the steps of a model to a trace
+    """
+
+    def __init__(self, path, model, keyframe_interval=100):
+        """
+        Create a new TraceWriter, write the header and the current state of
+        the model as the first keyframe.
+
+        Args:
+            path (str): the path of the data file, the index file is the
+                same path with ".idx" at the end
+            model (BoxPicking): the model
+            keyframe_interval (int): the number of steps between keyframes
+        """
+        self.keyframe_interval = keyframe_interval
+        self.data = open(path, "wb")
+        self.index = open(index_path(path), "wb")
+        self.offset = 0
+        self.records = 0
+        self.keyframe = 0
+        # index entries of the records not flushed yet
+        self.pending_index = []
+
+        meta = json.dumps({
+            "version": FORMAT_VERSION,
+            "width": model.width,
+            "height": model.height,
+            "n_boxes": model.number_of_boxes,
+            "n_robots": model.number_of_robots,
+            "seed": model.seed,
+            "max_steps": model.max_steps,
+            "stack_height": model.stack_height,
+            "stacking_zones": model.stacking_zones,
+            "first_step": model.schedule.steps,
+        }).encode()
+        self._write(MAGIC + np.uint32(len(meta)).tobytes() + meta)
+        self.write_frame(model, *model.get_snapshot(), full=True)
+        # the trace can be opened as soon as it is created
+        self.flush()
+
+    def _write(self, data):
+        self.data.write(data)
+        self.offset += len(data)
+
+    def write_frame(self, model, robots, boxes, full):
+        """
+        Append a record with the given agent records
+
+        Args:
+            model (BoxPicking): the model
+            robots (dict): robot records by unique id
+            boxes (dict): box records by unique id
+            full (bool): whether the records are every agent
+        """
+        if full:
+            self.keyframe = self.records
+        records = encode_records(robots, boxes)
+        header = np.array([(model.schedule.steps, model.running, full,
+                            len(records) // FRAME_DTYPE.itemsize)],
+                          dtype=RECORD_DTYPE)
+        ideal_positions = np.array(model.ideal_positions, dtype=IDEAL_DTYPE)
+        self.pending_index.append(np.array([(self.offset, self.keyframe)],
+                                           dtype=INDEX_DTYPE).tobytes())
+        self._write(header.tobytes() + ideal_positions.tobytes() + records)
+        self.records += 1
+
+    def write_step(self, model):
+        """
+        Append the step the model just did, as a keyframe every
+        keyframe_interval records
+
+        Args:
+            model (BoxPicking): the model, after its step
+        """
+        if self.records - self.keyframe >= self.keyframe_interval:
+            self.write_frame(model, *model.get_snapshot(), full=True)
+            # readers of a trace being written see it up to here
+            self.flush()
+        else:
+            _, robots, boxes = model.change_log[-1]
+            self.write_frame(model, robots, boxes, full=False)
+
+    def flush(self):
+        """
+        Write the data of the records and then their index entries
+        """
+        self.data.flush()
+        self.index.write(b"".join(self.pending_index))
+        self.pending_index.clear()
+        self.index.flush()
+
+    def close(self):
+        self.flush()
+        self.data.close()
+        self.index.close()
+
+
+class TraceReader:
+    """
+    Random access to the steps of a trace through memory-mapped files
+    """
+
+    def __init__(self, path):
+        """
+        Create a new TraceReader.
+
+        Args:
+            path (str): the path of the data file
+        """
+        # a trace being written can have a part of an entry at the end of
+        # its index, only the whole entries are read
+        records = os.path.getsize(index_path(path)) // INDEX_DTYPE.itemsize
+        if records == 0 or os.path.getsize(path) == 0:
+            raise TraceError(f"{path} has no steps yet")
+        self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        if bytes(self.data[:len(MAGIC)]) != MAGIC:
+            raise TraceError(f"{path} is not a trace")
+        start = len(MAGIC) + 4
+        meta_size = int(self.data[len(MAGIC):start].view("<u4")[0])
+        self.meta = json.loads(bytes(self.data[start:start + meta_size]))
+        if self.meta["version"] != FORMAT_VERSION:
+            raise TraceError(f"Unknown trace version: {self.meta['version']}")
+        self.index = np.memmap(index_path(path), dtype=INDEX_DTYPE, mode="r",
+                               shape=(records,))
+        self.n_zones = len(self.meta["stacking_zones"])
+        # last state built, reused when the next step asked for is after it
+        self.state = None
+        self.state_record = None
+        self.lock = threading.Lock()
+
+    @property
+    def first_step(self):
+        return self.meta["first_step"]
+
+    @property
+    def last_step(self):
+        return self.first_step + len(self.index) - 1
+
+    def read_record(self, number):
+        """
+        Returns a record of the data file, as views of the mapped file
+
+        Args:
+            number (int): the number of the record
+
+        Returns:
+            tuple: the header, the ideal positions and the agent records
+        """
+        offset = int(self.index[number]["offset"])
+        end = offset + RECORD_DTYPE.itemsize
+        header = self.data[offset:end].view(RECORD_DTYPE)[0]
+        offset, end = end, end + self.n_zones * 2 * IDEAL_DTYPE.itemsize
+        ideal_positions = self.data[offset:end].view(IDEAL_DTYPE)
+        offset = end
+        end = offset + int(header["count"]) * FRAME_DTYPE.itemsize
+        records = self.data[offset:end].view(FRAME_DTYPE)
+        return header, ideal_positions.reshape(-1, 2), records
+
+    def record_number(self, step):
+        """
+        Returns the number of the record of a step
+
+        Args:
+            step (int): the step
+
+        Returns:
+            int: the number of the record
+        """
+        if not self.first_step <= step <= self.last_step:
+            raise TraceError(f"Step {step} is not in the trace, it goes "
+                             f"from {self.first_step} to {self.last_step}")
+        return step - self.first_step
+
+    def get_frame(self, step):
+        """
+        Returns every agent at a step, built from its keyframe and the
+        changes after it
+
+        Args:
+            step (int): the step
+
+        Returns:
+            dict: the step, whether the model was running, the ideal
+                positions and the records of every agent sorted by id,
+                robots first
+        """
+        number = self.record_number(step)
+        keyframe = int(self.index[number]["keyframe"])
+        with self.lock:
+            if self.state_record is not None and \
+                    keyframe <= self.state_record <= number:
+                first = self.state_record + 1
+                state = self.state
+            else:
+                state = np.sort(self.read_record(keyframe)[2], order="id")
+                first = keyframe + 1
+            for record in range(first, number + 1):
+                changes = self.read_record(record)[2]
+                state[np.searchsorted(state["id"], changes["id"])] = changes
+            self.state = state
+            self.state_record = number
+            state = state.copy()
+        header, ideal_positions, _ = self.read_record(number)
+        return {"step": step,
+                "running": bool(header["running"]),
+                "ideal_positions": [tuple(position) for position in
+                                    ideal_positions.tolist()],
+                "records": state}
+
+    def get_changes(self, step):
+        """
+        Returns the agents that changed during a step
+
+        Args:
+            step (int): the step
+
+        Returns:
+            dict: the step, whether the model was running, whether the
+                records are every agent and the records
+        """
+        header, _, records = self.read_record(self.record_number(step))
+        return {"step": step,
+                "running": bool(header["running"]),
+                "full": bool(header["full"]),
+                "records": np.array(records)}
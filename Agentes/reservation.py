@@ -0,0 +1,88 @@
+class ReservationTable:
+    """
+    Space-time reservation of the cells the robots will be in on the next
+    step. A robot can reserve a cell that another robot is leaving, so a
+    line of robots moves forward together, but two robots can not reserve
+    the same cell or swap their cells. If a robot that is followed has to
+    stay, the robots behind it stay too
+    """
+
+    def __init__(self, grid):
+        """
+        Create a new ReservationTable.
+
+        Args:
+            grid (OccupancyGrid): the grid of the model
+        """
+        self.grid = grid
+        # reserved cell by robot id and robot of each reserved cell
+        self.next_cell = {}
+        self.reserved_by = {}
+
+    def clear(self):
+        """
+        Remove every reservation, called at the start of each step
+        """
+        self.next_cell.clear()
+        self.reserved_by.clear()
+
+    def is_reserved(self, cell):
+        """
+        Returns whether a robot will be in a cell on the next step
+
+        Args:
+            cell (tuple): the coordinates of the cell
+
+        Returns:
+            bool: True if the cell is reserved
+        """
+        return cell in self.reserved_by
+
+    def can_reserve(self, robot, cell):
+        """
+        Returns whether a robot can move to a cell on the next step
+
+        Args:
+            robot (Robot): the robot
+            cell (tuple): the coordinates of the cell
+
+        Returns:
+            bool: True if the cell is not reserved and the robot in it, if
+                any, is not staying or swapping cells with this robot
+        """
+        if cell in self.reserved_by:
+            return False
+        occupant = self.grid.robot_at(cell)
+        if occupant is not None and occupant is not robot:
+            planned = self.next_cell.get(occupant.unique_id)
+            if planned == cell or planned == robot.pos:
+                return False
+        return True
+
+    def reserve(self, robot, cell):
+        """
+        Reserve a cell for a robot
+
+        Args:
+            robot (Robot): the robot
+            cell (tuple): the coordinates of the cell
+        """
+        self.next_cell[robot.unique_id] = cell
+        self.reserved_by[cell] = robot
+
+    def stay(self, robot):
+        """
+        Reserve the cell of a robot for itself. The robot that reserved
+        that cell to follow it has to stay too, and so on
+
+        Args:
+            robot (Robot): the robot
+        """
+        while robot is not None:
+            follower = self.reserved_by.get(robot.pos)
+            self.reserve(robot, robot.pos)
+            if follower is None or follower is robot:
+                return
+            # the follower lost its cell
+            del self.next_cell[follower.unique_id]
+            robot = follower
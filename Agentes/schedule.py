@@ -0,0 +1,146 @@
+import numpy as np
+from mesa.time import RandomActivation
+
+# von Neumann neighborhood, the same cells Robot.move_randomly uses
+NEIGHBOR_OFFSETS = np.array([(0, 1), (1, 0), (0, -1), (-1, 0)])
+
+
+class BatchedActivation(RandomActivation):
+    """
+    Activates the robots in random order like RandomActivation, but the
+    robots without a box and with no box next to them are not moved one by
+    one. All of them take their random step together in one vectorized pass
+    over the occupancy arrays of the grid. When the model uses the box
+    search every robot moves one by one, because no robot walks randomly
+    """
+
+    def __init__(self, model):
+        """
+        Create a new BatchedActivation scheduler.
+
+        Args:
+            model (Model): the model the scheduler belongs to
+        """
+        super().__init__(model)
+        # seeded from the model so the runs stay reproducible
+        self.rng = np.random.default_rng(model.random.getrandbits(64))
+
+    def step(self):
+        """
+        Step the robots that carry or can pick a box in random order, then
+        move all the other robots randomly at once
+        """
+        walkers = []
+        for agent in self.agent_buffer(shuffled=True):
+            agent.update_ideal_position()
+            if agent.has_box or self.model.box_search is not None or \
+                    agent.get_neighboor_box_position() is not None:
+                agent.move()
+            else:
+                walkers.append(agent)
+        self.move_walkers(walkers)
+        self.steps += 1
+        self.time += 1
+
+    def move_walkers(self, walkers):
+        """
+        Move every walker to a random empty neighbor cell that is not a
+        stacking position. If several walkers choose the same cell, the one
+        with the highest random priority gets it and the others stay. A
+        walker with no free cell orders its neighbors carrying a box to move
+        randomly on the next step, as Robot.move_randomly does
+
+        Args:
+            walkers (list): the robots to move
+        """
+        if not walkers:
+            return
+        model = self.model
+        grid = model.grid
+        n_walkers = len(walkers)
+
+        positions = np.array([walker.pos for walker in walkers])
+        candidates = positions[:, None, :] + NEIGHBOR_OFFSETS[None, :, :]
+        x = candidates[..., 0]
+        y = candidates[..., 1]
+        inside = (x >= 0) & (x < grid.width) & (y >= 0) & (y < grid.height)
+        x = np.clip(x, 0, grid.width - 1)
+        y = np.clip(y, 0, grid.height - 1)
+        free = inside & (grid.agent_count[x, y] == 0) & \
+            ~grid.stacking_mask[x, y]
+
+        # pick a random free neighbor for every walker
+        keys = self.rng.random(free.shape)
+        keys[~free] = -1
+        choice = keys.argmax(axis=1)
+        can_move = free.any(axis=1)
+        rows = np.arange(n_walkers)
+        targets = candidates[rows, choice]
+
+        # solve the conflicts, for each target the walker with the lowest
+        # priority value wins
+        priority = self.rng.permutation(n_walkers)
+        movers = rows[can_move]
+        target_cells = targets[movers, 0] * grid.height + targets[movers, 1]
+        order = np.lexsort((priority[movers], target_cells))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = target_cells[order][1:] != target_cells[order][:-1]
+        winners = movers[order[first]]
+        # the walkers that lost a cell or had none collided
+        model.record_collisions(n_walkers - len(winners))
+
+        for i in winners:
+            grid.move_agent(walkers[i], (int(targets[i, 0]),
+                                         int(targets[i, 1])))
+        model.movements += len(winners)
+
+        for i in rows[~can_move]:
+            walker = walkers[i]
+            for neighboor in grid.iter_neighborhood(
+                    walker.pos, moore=False, include_center=False):
+                robot = grid.robot_at(neighboor)
+                if robot is not None and robot.has_box:
+                    robot.move_random_with_box = True
+
+
+class ReservationActivation(RandomActivation):
+    """
+    Steps the robots in two phases. In the planning phase the robots, in
+    random order, stack or pick a box if they can, or reserve the most
+    wanted neighbor cell that is free on the next step in the reservation
+    table of the model. In the second phase every robot moves to its
+    reserved cell at the same time, so robots can follow each other and go
+    around each other instead of waiting
+    """
+
+    def step(self):
+        """
+        Plan the moves of all the robots and then do them
+        """
+        model = self.model
+        table = model.reservations
+        table.clear()
+        robots = list(self.agent_buffer(shuffled=True))
+        for robot in robots:
+            robot.update_ideal_position()
+            if robot.act_in_place():
+                table.stay(robot)
+                continue
+            for cell in robot.get_candidate_positions():
+                if table.can_reserve(robot, cell):
+                    table.reserve(robot, cell)
+                    break
+            else:
+                table.stay(robot)
+
+        for robot in robots:
+            cell = table.next_cell[robot.unique_id]
+            if cell == robot.pos:
+                continue
+            if robot.has_box:
+                robot.move_with_box(cell[0], cell[1])
+            else:
+                model.grid.move_agent(robot, cell)
+            model.movements += 1
+        self.steps += 1
+        self.time += 1
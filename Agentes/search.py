@@ -0,0 +1,356 @@
+import heapq
+
+import numpy as np
+
+from schedule import NEIGHBOR_OFFSETS
+
+# distance of the cells that can not reach any box
+UNREACHED = np.iinfo(np.int32).max
+# a repair that has to visit more cells than the larger of these is given
+# up for a full rebuild, which is vectorized
+MIN_REPAIR_CELLS = 256
+REPAIR_FRACTION = 16
+
+
+class BoxSearch:
+    """
+    Guides the robots without a box to the nearest loose box. A distance
+    field is built with a breadth first search that starts from every cell
+    with a loose box at the same time, and each cell also remembers which
+    box cell is the nearest one. A robot claims the box cell nearest to it,
+    so no two robots chase the same box, and walks down the field towards
+    it. When the cells with loose boxes or the stacking positions change,
+    the field is repaired around the cells that changed, and rebuilt only
+    when the repair would touch too many cells
+    """
+
+    def __init__(self, model):
+        """
+        Create a new BoxSearch.
+
+        Args:
+            model (Model): the model the search belongs to
+        """
+        self.model = model
+        shape = (model.width, model.height)
+        self.distance = np.full(shape, UNREACHED, dtype=np.int32)
+        # linear index (x * height + y) of the nearest box cell, -1 if none
+        self.nearest = np.full(shape, -1, dtype=np.int64)
+        # cells with a loose box and cells the robots can not go through,
+        # as they were when the field was last updated
+        self.sources = np.zeros(shape, dtype=bool)
+        self.blocked = np.zeros(shape, dtype=bool)
+        self.version = None
+        # cells whose layout changed since the last update
+        self.changed_cells = set()
+        model.grid.layout_listeners.append(self.changed_cells.add)
+        # claimed box cells by robot id and the robot of each claimed cell
+        self.claims = {}
+        self.claimed_by = {}
+
+    def update(self):
+        """
+        Bring the distance field up to date if the grid layout changed
+        """
+        grid = self.model.grid
+        if self.version == grid.layout_version:
+            return
+        if self.version is None or not self.changed_cells or \
+                not self.repair(self.changed_cells):
+            self.rebuild()
+        self.changed_cells.clear()
+        self.version = grid.layout_version
+
+    def rebuild(self):
+        """
+        Build the distance field of the whole grid
+        """
+        grid = self.model.grid
+        self.sources = grid.loose_count > 0
+        self.blocked = self.sources | grid.stacking_mask
+        self.distance, self.nearest = build_field(self.sources, self.blocked)
+
+    def neighbors(self, cell):
+        """
+        Returns the neighbor cells inside the grid, in the order of
+        NEIGHBOR_OFFSETS
+
+        Args:
+            cell (tuple): the coordinates of the cell
+
+        Returns:
+            list: the coordinates of the neighbors
+        """
+        x, y = cell
+        width, height = self.model.width, self.model.height
+        return [(x + dx, y + dy) for dx, dy in OFFSETS
+                if 0 <= x + dx < width and 0 <= y + dy < height]
+
+    def parent(self, cell):
+        """
+        Returns the cell a cell takes its nearest box from, the first cell
+        one step closer in the order the breadth first search reaches it
+
+        Args:
+            cell (tuple): the coordinates of a reached cell that is not a
+                box cell
+
+        Returns:
+            tuple: the coordinates of the parent
+        """
+        x, y = cell
+        width, height = self.model.width, self.model.height
+        level = self.distance[cell] - 1
+        for dx, dy in OFFSETS:
+            parent = (x - dx, y - dy)
+            if 0 <= parent[0] < width and 0 <= parent[1] < height and \
+                    self.distance[parent] == level:
+                return parent
+        return None
+
+    def repair(self, changed):
+        """
+        Repair the field after some cells gained or lost their loose boxes
+        or became stacking positions. The cells that reached their box
+        through a changed cell are reset and reached again from the cells
+        around them, then the nearest box is chosen again in order of
+        distance, so the field is the same a full rebuild would give
+
+        Args:
+            changed (set): the cells whose layout changed
+
+        Returns:
+            bool: False if the repair touched too many cells and the field
+                has to be rebuilt
+        """
+        grid = self.model.grid
+        height = self.model.height
+        limit = max(MIN_REPAIR_CELLS,
+                    self.model.width * height // REPAIR_FRACTION)
+        distance = self.distance
+        nearest = self.nearest
+        sources = self.sources
+        blocked = self.blocked
+
+        cells = []
+        for cell in changed:
+            source = bool(grid.loose_count[cell] > 0)
+            wall = source or bool(grid.stacking_mask[cell])
+            if source != sources[cell] or wall != blocked[cell]:
+                cells.append(cell)
+        if not cells:
+            return True
+
+        # the cells whose way to their box goes through a changed cell
+        reset = {cell for cell in cells if distance[cell] != UNREACHED}
+        pending = list(reset)
+        while pending:
+            cell = pending.pop()
+            level = distance[cell] + 1
+            for neighbor in self.neighbors(cell):
+                if neighbor not in reset and distance[neighbor] == level \
+                        and self.parent(neighbor) == cell:
+                    reset.add(neighbor)
+                    pending.append(neighbor)
+            if len(reset) > limit:
+                return False
+
+        for cell in cells:
+            sources[cell] = grid.loose_count[cell] > 0
+            blocked[cell] = sources[cell] or grid.stacking_mask[cell]
+        for cell in reset:
+            distance[cell] = UNREACHED
+            nearest[cell] = -1
+        queue = []
+        for cell in cells:
+            if sources[cell]:
+                distance[cell] = 0
+                nearest[cell] = cell[0] * height + cell[1]
+                queue.append((0, cell))
+        for cell in reset:
+            for neighbor in self.neighbors(cell):
+                if neighbor not in reset and \
+                        distance[neighbor] != UNREACHED:
+                    queue.append((int(distance[neighbor]), neighbor))
+
+        # reach the cells again, lowering the distances the new box cells
+        # and the cells that are free again make shorter
+        heapq.heapify(queue)
+        moved = set(reset)
+        moved.update(cells)
+        while queue:
+            level, cell = heapq.heappop(queue)
+            if level != distance[cell]:
+                continue
+            for neighbor in self.neighbors(cell):
+                if not blocked[neighbor] and \
+                        level + 1 < distance[neighbor]:
+                    distance[neighbor] = level + 1
+                    moved.add(neighbor)
+                    heapq.heappush(queue, (level + 1, neighbor))
+            if len(moved) > limit:
+                return False
+
+        # choose the nearest box again, every cell after its parent
+        queue = set()
+        for cell in moved:
+            queue.add(cell)
+            queue.update(self.neighbors(cell))
+        queue = [(int(distance[cell]), cell) for cell in queue
+                 if distance[cell] != UNREACHED]
+        heapq.heapify(queue)
+        done = set()
+        while queue:
+            level, cell = heapq.heappop(queue)
+            if cell in done:
+                continue
+            done.add(cell)
+            if level == 0:
+                box = cell[0] * height + cell[1]
+            else:
+                box = int(nearest[self.parent(cell)])
+            if box != nearest[cell] or cell in moved:
+                nearest[cell] = box
+                for neighbor in self.neighbors(cell):
+                    if distance[neighbor] == level + 1 and \
+                            neighbor not in done:
+                        heapq.heappush(queue, (level + 1, neighbor))
+            if len(done) > 4 * limit:
+                return False
+        return True
+
+    def get_claim(self, robot):
+        """
+        Returns the box cell claimed by a robot, claiming the nearest
+        unclaimed one if the robot has none
+
+        Args:
+            robot (Robot): the robot looking for a box
+
+        Returns:
+            tuple: the coordinates of the claimed cell, None if the nearest
+                box is claimed by another robot or there is no box
+        """
+        grid = self.model.grid
+        claim = self.claims.get(robot.unique_id)
+        if claim is not None and grid.loose_boxes_in_cell(claim) > 0:
+            return claim
+        self.release(robot)
+
+        self.update()
+        nearest = self.nearest[robot.pos[0], robot.pos[1]]
+        if nearest < 0:
+            return None
+        claim = divmod(int(nearest), self.model.height)
+        if claim in self.claimed_by:
+            return None
+        self.claims[robot.unique_id] = claim
+        self.claimed_by[claim] = robot.unique_id
+        return claim
+
+    def release(self, robot):
+        """
+        Release the box cell claimed by a robot
+
+        Args:
+            robot (Robot): the robot
+        """
+        claim = self.claims.pop(robot.unique_id, None)
+        if claim is not None:
+            self.claimed_by.pop(claim, None)
+
+    def next_position(self, robot, claim):
+        """
+        Returns the free neighbor cell of the robot that is one step closer
+        to the claimed box, preferring the cells whose nearest box is the
+        claimed one
+
+        Args:
+            robot (Robot): the robot
+            claim (tuple): the claimed box cell
+
+        Returns:
+            tuple: the coordinates of the next cell, None if the robot can
+                not get closer
+        """
+        self.update()
+        grid = self.model.grid
+        claim_index = claim[0] * self.model.height + claim[1]
+        current = self.distance[robot.pos[0], robot.pos[1]]
+        best = None
+        best_key = None
+        for neighboor in grid.iter_neighborhood(
+                robot.pos, moore=False, include_center=False):
+            distance = self.distance[neighboor[0], neighboor[1]]
+            if distance >= current or grid.cell_count(neighboor) != 0 or \
+                    grid.is_stacking_position(neighboor):
+                continue
+            key = (self.nearest[neighboor[0], neighboor[1]] != claim_index,
+                   distance)
+            if best_key is None or key < best_key:
+                best = neighboor
+                best_key = key
+        return best
+
+
+# the offsets as tuples, for the searches that go cell by cell
+OFFSETS = [tuple(offset) for offset in NEIGHBOR_OFFSETS.tolist()]
+
+
+def build_field(sources, blocked):
+    """
+    Build a distance field with a breadth first search that starts from
+    every source cell at the same time
+
+    Args:
+        sources (numpy.ndarray): the cells with a loose box
+        blocked (numpy.ndarray): the cells the search can not go through
+
+    Returns:
+        tuple: the distance of every cell to its nearest source and the
+            linear index of that source, -1 if none can be reached
+    """
+    distance = np.full(sources.shape, UNREACHED, dtype=np.int32)
+    nearest = np.full(sources.shape, -1, dtype=np.int64)
+    distance[sources] = 0
+    nearest[sources] = np.flatnonzero(sources)
+
+    frontier = sources
+    level = 0
+    while frontier.any():
+        level += 1
+        reached = np.zeros_like(frontier)
+        for dx, dy in NEIGHBOR_OFFSETS:
+            source_cells, target_cells = shifted_slices(dx, dy)
+            new = frontier[source_cells] & \
+                ~blocked[target_cells] & \
+                (distance[target_cells] == UNREACHED) & \
+                ~reached[target_cells]
+            nearest[target_cells][new] = nearest[source_cells][new]
+            reached[target_cells] |= new
+        distance[reached] = level
+        frontier = reached
+    return distance, nearest
+
+
+def shifted_slices(dx, dy):
+    """
+    Returns the slices that align every cell with its neighbor at (dx, dy)
+
+    Args:
+        dx (int): the offset in x
+        dy (int): the offset in y
+
+    Returns:
+        tuple: the slices of the source cells and of the target cells
+    """
+    def axis(offset):
+        if offset > 0:
+            return slice(None, -offset), slice(offset, None)
+        if offset < 0:
+            return slice(-offset, None), slice(None, offset)
+        return slice(None), slice(None)
+
+    source_x, target_x = axis(dx)
+    source_y, target_y = axis(dy)
+    return (source_x, source_y), (target_x, target_y)
@@ -9,6 +9,8 @@ GRID_HEIGHT = 15
 
 MAX_STEPS = 10000
 NUMBER_OF_BOXES = 115
+NUMBER_OF_ROBOTS = 5
+STACK_HEIGHT = 5
 
 
 def agent_portrayal(agent):
@@ -23,10 +25,10 @@ def agent_portrayal(agent):
                      "text_color": "white"}
 
     elif isinstance(agent, Box):
-        # if the agent is a box, placed correctly and its stack size is 5, 
+        # if the agent is a box, placed correctly and its stack is full,
         # return a blue rectangle
         if agent.is_placed_correctly and agent.get_number_of_boxes_in_stack() \
-                == 5:
+                >= agent.model.stack_height:
             portrayal = {"Shape": "rect",
                          "Filled": "true",
                          "Color": "rgb(0, 255, 0)",
@@ -35,10 +37,11 @@ def agent_portrayal(agent):
                          "Layer": 0,
                          "text": agent.get_number_of_boxes_in_stack(),
                          "text_color": "black"}
-        # if the agent is a box, placed correctly and its stack size is 
-        # less than 5, return a yellow rectangle
+        # if the agent is a box, placed correctly and its stack is not
+        # full, return a yellow rectangle
         elif agent.is_placed_correctly and \
-                agent.get_number_of_boxes_in_stack() < 5:
+                agent.get_number_of_boxes_in_stack() < \
+                agent.model.stack_height:
             portrayal = {"Shape": "rect",
                          "Filled": "true",
                          "Color": "rgb(255, 255, 0)",
@@ -57,7 +60,7 @@ def agent_portrayal(agent):
                          "h": 0.6,
                          "Layer": 0}
         # if the agent is not picked up, not placed correctly 
-        # and its stack size is less than 5, return a red rectangle
+        # and its stack is not full, return a red rectangle
         else:
             portrayal = {"Shape": "rect",
                          "Filled": "true",
@@ -75,7 +78,9 @@ server = ModularServer(BoxPicking,
                        [grid],
                        "Box Picking",
                        {"n_boxes": NUMBER_OF_BOXES, "width": GRID_WIDTH,
-                        "height": GRID_HEIGHT, "max_steps": MAX_STEPS})
+                        "height": GRID_HEIGHT, "max_steps": MAX_STEPS,
+                        "n_robots": NUMBER_OF_ROBOTS,
+                        "stack_height": STACK_HEIGHT})
 
 server.port = 8521  # The default
 server.launch()
@@ -1,108 +1,576 @@
-from flask import Flask, request, jsonify
+import io
+import json
+import os
+import threading
+
+from flask import Flask, Response, request, jsonify
 from model import *
 from agent import *
+from checkpoint import get_parameters, read_checkpoint, \
+    restore_checkpoint, save_checkpoint
+from encoding import BINARY_MIMETYPE, ROBOT_FLAG, HAS_BOX_FLAG, \
+    encode_records
+from recording import TraceError, TraceReader
+
+from sessions import CapacityError, SessionError, SessionRegistry
 
 # Size of the board:
 NUMBER_OF_BOXES = 115
+NUMBER_OF_ROBOTS = 5
 width = 15
 height = 15
-randomModel = None
-currentStep = 0
 max_steps = 5000
-running = True
+
+# Segundos sin pasos nuevos antes de mandar un comentario por /stream, así
+# la conexión no se cierra y se detecta si el cliente se fue
+KEEPALIVE_SECONDS = 15
+
+# Carpeta de los archivos de trazas que se pueden reproducir con /replay
+TRACE_DIR = os.environ.get('TRACE_DIR', 'traces')
+# Máximo de pasos que regresa /replay/range en una solicitud
+MAX_REPLAY_STEPS = 1000
+
+# Cada cliente tiene su propia sesión con su modelo. Las solicitudes sin
+# "session" usan la última sesión creada con /init
+sessions = SessionRegistry()
+# Trazas abiertas por nombre, con el tamaño de su índice al abrirlas
+traces = {}
+traces_lock = threading.Lock()
 
 app = Flask("Robot-box example")
 
 
+@app.errorhandler(SessionError)
+def sessionError(error):
+    return jsonify({"message": str(error)}), 404
+
+
+# Un modelo que no cabe en la memoria del servidor no es un error de sesión
+@app.errorhandler(CapacityError)
+def capacityError(error):
+    return jsonify({"message": str(error)}), 413
+
+
+@app.errorhandler(TraceError)
+def traceError(error):
+    return jsonify({"message": str(error)}), 404
+
+
+def getSession():
+    # La sesión puede venir en la URL o en la forma
+    return sessions.get(request.values.get('session'))
+
+
+def invalidParameters():
+    return jsonify({"message": "Invalid parameters."}), 400
+
+
 @app.route('/init', methods=['POST', 'GET'])
 def initModel():
-    global currentStep, randomModel, width, height, NUMBER_OF_BOXES, max_steps
-
     # Datos que estamos mandando
     if request.method == 'POST':
-        width = int(request.form.get('width'))
-        height = int(request.form.get('height'))
-        NUMBER_OF_BOXES = int(request.form.get('NBoxes'))
-        # PReguntar max steps
-        max_steps = int(request.form.get('MaxSteps'))
-        currentStep = 0
+        # Un parámetro que falta o no es un número se responde con 400
+        try:
+            width = int(request.form.get('width'))
+            height = int(request.form.get('height'))
+            NUMBER_OF_BOXES = int(request.form.get('NBoxes'))
+            # PReguntar max steps
+            max_steps = int(request.form.get('MaxSteps'))
+            # El número de robots y la semilla son opcionales, con la misma
+            # semilla el modelo hace los mismos pasos
+            n_robots = int(request.form.get('NRobots', NUMBER_OF_ROBOTS))
+        except (ValueError, TypeError):
+            return invalidParameters()
+        seed = request.form.get('Seed', type=int)
+        # Con Profile=true el modelo mide sus pasos, se consultan en /metrics
+        profile = request.form.get('Profile', 'false').lower() == 'true'
+        # Contar las consultas a la cuadrícula hace más lento cada paso, se
+        # pide aparte con ProfileQueries=true
+        profile_queries = \
+            request.form.get('ProfileQueries', 'false').lower() == 'true'
+        # Con Rate el modelo avanza solo en segundo plano, Rate pasos por
+        # segundo (0 lo más rápido posible)
+        rate = request.form.get('Rate', type=float)
+        # Con BoxStorage=compact las cajas se guardan en arreglos, para
+        # almacenes muy grandes
+        box_storage = request.form.get('BoxStorage', 'agents')
+        if box_storage not in BOX_STORAGES:
+            message = f"Unknown BoxStorage: {box_storage}."
+            return jsonify({"message": message}), 400
+        # El tamaño se revisa antes de crear el modelo, un modelo demasiado
+        # grande se rechaza sin llegar a ocupar la memoria
+        try:
+            sessions.check_memory(width, height, NUMBER_OF_BOXES, n_robots,
+                                  box_storage)
+
+            # Aquí se crea el modelo, con más cajas que celdas o un tamaño
+            # inválido el modelo lanza ValueError
+            model = BoxPicking(width, height, NUMBER_OF_BOXES, max_steps,
+                               seed=seed, n_robots=n_robots, profile=profile,
+                               box_storage=box_storage,
+                               profile_queries=profile_queries)
+        except (ValueError, TypeError):
+            return invalidParameters()
+        session = sessions.create(model, max_steps)
+        if rate is not None:
+            session.start_stepping(rate)
+
+        return jsonify({"message": "Parameters recieved, model initiated.",
+                        "session": session.id})
+
+
+# Cierra una sesión y libera su modelo
+@app.route('/close', methods=['POST', 'GET'])
+def closeModel():
+    session = getSession()
+    sessions.remove(session.id)
+    return jsonify({"message": f"Session {session.id} closed."})
+
+
+# Avanza el modelo en segundo plano, "rate" pasos por segundo (sin rate lo
+# más rápido posible). Mientras avanza, /getAgents, /getObstacles y
+# /getState regresan el último paso terminado sin esperar al siguiente
+@app.route('/start', methods=['POST', 'GET'])
+def startModel():
+    session = getSession()
+    rate = request.values.get('rate', type=float)
+    session.start_stepping(rate)
+    return jsonify({"message": "Model stepping in the background.",
+                    "currentStep": session.current_step})
 
-        # Aquí se crea el modelo
-        randomModel = BoxPicking(width, height, NUMBER_OF_BOXES, max_steps)
 
-        return jsonify({"message": "Parameters recieved, model initiated."})
+# Detiene el avance en segundo plano, el modelo vuelve a avanzar con
+# /update o /run
+@app.route('/stop', methods=['POST', 'GET'])
+def stopModel():
+    session = getSession()
+    session.stop_stepping()
+    return jsonify({"message": "Model stopped.",
+                    "currentStep": session.current_step})
+
+
+def withModel(session, function):
+    # Llama function con el modelo. Si el modelo avanza en segundo plano la
+    # llama el hilo entre dos pasos, sin pelear por el candado de la sesión
+    worker = session.worker
+    if worker is not None:
+        return worker.call(function)
+    with session.lock:
+        return function(session.model)
+
+
+def steppingError():
+    # /update y /run no pueden avanzar un modelo que avanza solo
+    return jsonify({"message": "The model is stepping in the background, "
+                               "call /stop first."}), 409
+
+
+# Regresa el estado completo del modelo para continuarlo después con
+# /restore
+@app.route('/checkpoint', methods=['GET'])
+def checkpointModel():
+    session = getSession()
+    data = io.BytesIO()
+
+    def checkpoint(model):
+        save_checkpoint(model, data)
+        return model.schedule.steps
+    step = withModel(session, checkpoint)
+    return Response(data.getvalue(), mimetype=BINARY_MIMETYPE,
+                    headers={'X-Current-Step': str(step)})
+
+
+# Crea una sesión nueva con el modelo de un checkpoint enviado en el cuerpo
+@app.route('/restore', methods=['POST'])
+def restoreModel():
+    # Los parámetros vienen del cliente: se revisan y se mide el modelo
+    # antes de crearlo
+    try:
+        checkpoint = read_checkpoint(io.BytesIO(request.get_data()))
+        parameters = get_parameters(checkpoint)
+    except (ValueError, KeyError, TypeError, OSError):
+        return jsonify({"message": "Invalid checkpoint."}), 400
+    if parameters.get('box_storage', 'agents') not in BOX_STORAGES:
+        return jsonify({"message": "Invalid checkpoint."}), 400
+    sessions.check_memory(parameters['width'], parameters['height'],
+                          parameters['n_boxes'], parameters['n_robots'],
+                          parameters.get('box_storage', 'agents'))
+    try:
+        model = restore_checkpoint(checkpoint)
+    except (ValueError, KeyError, TypeError, IndexError):
+        return jsonify({"message": "Invalid checkpoint."}), 400
+    session = sessions.create(model, model.max_steps)
+    session.current_step = model.schedule.steps
+    return jsonify({"message": "Checkpoint restored, model initiated.",
+                    "session": session.id,
+                    "currentStep": session.current_step})
+
+
+# Tiempos y contadores del modelo, solo si se creó con Profile=true
+@app.route('/metrics', methods=['GET'])
+def getMetrics():
+    session = getSession()
+    if session.model.profiler is None:
+        return jsonify({"message": "The model was not created with "
+                                   "Profile=true."}), 404
+    # Con el modelo en segundo plano se regresan las medidas del último
+    # paso publicado
+    worker = session.worker
+    if worker is not None:
+        with worker.frames.read() as frame:
+            metrics = dict(frame.metrics)
+            metrics['currentStep'] = frame.step
+    else:
+        with session.lock:
+            model = session.model
+            metrics = model.profiler.get_metrics()
+            metrics['currentStep'] = model.schedule.steps
+    return jsonify(metrics)
+
 
 # Para obtener si esta corriendo
 
 
 @app.route('/getState', methods=['GET'])
 def getState():
-    global randomModel
-
     if request.method == 'GET':
-
-        return jsonify({'running': randomModel.running})
+        session = getSession()
+        return frameResponse(session, 'state', stateBody)
 
 # Para obtener agentes
 
 
+def robotsToPositions(robots):
+    # Registros de robots del modelo al formato que espera Unity
+    return [{"id": str(unique_id), "x": x, "y": .4, "z": z, "box": has_box}
+            for unique_id, (x, z, has_box) in robots.items()]
+
+
+def boxesToPositions(boxes):
+    # Registros de cajas del modelo, una encima de otra si están apiladas
+    return [{"id": str(unique_id), "x": x, "y": 0.3 + 0.6 * level, "z": z}
+            for unique_id, (x, z, level) in boxes.items()]
+
+
+def currentStep(session):
+    # Último paso terminado, con el modelo en segundo plano no espera al
+    # paso en curso
+    worker = session.worker
+    if worker is not None:
+        with worker.frames.read() as frame:
+            return frame.step
+    with session.lock:
+        return session.model.schedule.steps
+
+
+def getFrame(session):
+    # Registros del último paso terminado. Se leen del modelo una sola vez
+    # por paso y los comparten /getAgents, /getObstacles y /getState
+    frame = session.frame_cache
+    if frame is not None and frame['step'] == currentStep(session):
+        return frame
+    worker = session.worker
+    if worker is not None:
+        with worker.frames.read() as buffered:
+            step, running = buffered.step, buffered.running
+            robots, boxes = dict(buffered.robots), dict(buffered.boxes)
+    else:
+        with session.lock:
+            model = session.model
+            step, running = model.schedule.steps, model.running
+            robots, boxes = model.get_snapshot()
+    frame = {'step': step, 'running': running, 'robots': robots,
+             'boxes': boxes, 'bodies': {}}
+    session.frame_cache = frame
+    return frame
+
+
+def stateBody(frame, binary):
+    return app.json.dumps({'running': frame['running']})
+
+
+def agentsBody(frame, binary):
+    if binary:
+        return encode_records(robots=frame['robots'])
+    return app.json.dumps({'positions': robotsToPositions(frame['robots'])})
+
+
+def obstaclesBody(frame, binary):
+    if binary:
+        return encode_records(boxes=frame['boxes'])
+    return app.json.dumps({'positions': boxesToPositions(frame['boxes'])})
+
+
+def frameResponse(session, name, build):
+    # Respuesta con el cuerpo del cuadro ya serializado. El ETag cambia con
+    # cada paso, si el cliente manda el mismo en If-None-Match se regresa
+    # 304 sin cuerpo
+    frame = getFrame(session)
+    binary = name != 'state' and wantsBinary()
+    body = frame['bodies'].get((name, binary))
+    if body is None:
+        body = build(frame, binary)
+        frame['bodies'][(name, binary)] = body
+    response = Response(body, mimetype=BINARY_MIMETYPE if binary
+                        else 'application/json')
+    response.set_etag(f"{session.id}-{frame['step']}-{name}-"
+                      f"{'binary' if binary else 'json'}")
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept')
+    return response.make_conditional(request)
+
+
+def wantsBinary():
+    # El cliente pide el formato binario con ?format=binary o con el
+    # encabezado Accept: application/octet-stream
+    if request.args.get('format') == 'binary':
+        return True
+    return request.accept_mimetypes.best_match(
+        ['application/json', BINARY_MIMETYPE]) == BINARY_MIMETYPE
+
+
+def binaryResponse(robots=None, boxes=None, headers=None):
+    # Los datos que no son posiciones van en los encabezados
+    return Response(encode_records(robots, boxes), mimetype=BINARY_MIMETYPE,
+                    headers=headers)
+
+
 @app.route('/getAgents', methods=['GET'])
 def getAgents():
-    global randomModel
-
     if request.method == 'GET':
-        # List comprehension
-        agentsPositions = []
-        for i in list(randomModel.grid.coord_iter()):
-            agents = i[0]
-            x = i[1]
-            z = i[2]
-            for a in agents:
-                if isinstance(a, Robot):
-                    agentsPositions.append(
-                        {"id": str(a.unique_id),
-                         "x": x,
-                         "y": .4,
-                         "z": z,
-                         "box": a.has_box})
-
-        return jsonify({'positions': agentsPositions})
+        session = getSession()
+        return frameResponse(session, 'agents', agentsBody)
 
 
 # Para obtener obstáculos
 @app.route('/getObstacles', methods=['GET'])
 def getObstacles():
-    global randomModel
-
     if request.method == 'GET':
-        # List comprehension
-
-        carPositions = []
-        for i in list(randomModel.grid.coord_iter()):
-            agents = i[0]
-            x = i[1]
-            z = i[2]
-
-            y = 0
-            for a in agents:
-                if isinstance(a, Box):
-                    carPositions.append(
-                        {"id": str(a.unique_id), "x": x, "y": 0.3 + y, "z": z})
-                    y += 0.6
-
-        return jsonify({'positions': carPositions})
+        session = getSession()
+        return frameResponse(session, 'obstacles', obstaclesBody)
 
 
 # Se encarga de hacerle el update al modelo, puede ser muy tardado
 @app.route('/update', methods=['GET'])
 def updateModel():
-    global currentStep, randomModel
     if request.method == 'GET':
-        randomModel.step()
-        currentStep += 1
+        session = getSession()
+        if session.worker is not None:
+            return steppingError()
+        with session.lock:
+            session.model.step()
+            session.current_step += 1
+            currentStep = session.current_step
+        session.stepped()
         return jsonify({'message': f'Model updated to step {currentStep}.',
                         'currentStep': currentStep})
 
 
+# Avanza varios pasos en una sola solicitud y regresa los cuadros para que
+# el cliente los reproduzca localmente
+@app.route('/run', methods=['GET'])
+def runModel():
+    if request.method == 'GET':
+        session = getSession()
+        if session.worker is not None:
+            return steppingError()
+        # Número de pasos a avanzar, por defecto hasta que termine
+        steps = request.args.get('steps', default=session.max_steps, type=int)
+        # Se manda un cuadro cada "every" pasos
+        every = max(request.args.get('every', default=1, type=int), 1)
+
+        frames = []
+        with session.lock:
+            model = session.model
+            for i in range(steps):
+                if not model.running:
+                    break
+                model.step()
+                session.current_step += 1
+                session.stepped()
+                if session.current_step % every == 0 or not model.running \
+                        or i == steps - 1:
+                    robots, boxes = model.get_snapshot()
+                    frames.append({'step': session.current_step,
+                                   'running': model.running,
+                                   'agents': robotsToPositions(robots),
+                                   'obstacles': boxesToPositions(boxes)})
+
+            return jsonify({'currentStep': session.current_step,
+                            'running': model.running,
+                            'frames': frames})
+
+
+def readChanges(session, since):
+    # Registros que cambiaron después del paso "since", o todos si el
+    # modelo ya no guarda esos pasos. Con el modelo en segundo plano salen
+    # de los cuadros publicados, sin esperar al paso en curso
+    worker = session.worker
+    if worker is not None:
+        return worker.frames.get_changes_since(since)
+    with session.lock:
+        model = session.model
+        changes = model.get_changes_since(since)
+        full = changes is None
+        if full:
+            changes = model.get_snapshot()
+        robots, boxes = changes
+        return model.schedule.steps, model.running, robots, boxes, full
+
+
+# Regresa solo los agentes que cambiaron después del paso "since". Si el
+# modelo ya no guarda esos pasos, regresa todo el estado con full = True
+@app.route('/getChanges', methods=['GET'])
+def getChanges():
+    if request.method == 'GET':
+        session = getSession()
+        since = request.args.get('since', default=0, type=int)
+        step, running, robots, boxes, full = readChanges(session, since)
+
+        if wantsBinary():
+            return binaryResponse(robots, boxes, headers={
+                'X-Current-Step': str(step),
+                'X-Running': str(running).lower(),
+                'X-Full': str(full).lower()})
+        return jsonify({'currentStep': step,
+                        'running': running,
+                        'full': full,
+                        'agents': robotsToPositions(robots),
+                        'obstacles': boxesToPositions(boxes)})
+
+
+def streamEvents(session, since):
+    # Espera cada paso nuevo y manda los cambios desde el último evento. El
+    # generador solo avanza cuando el servidor terminó de escribir el evento
+    # anterior, así que a un cliente lento no se le acumulan cuadros: el
+    # siguiente evento junta los cambios de todos los pasos que se perdió
+    last = since
+    while not session.closed:
+        # Un canal abierto cuenta como uso, la sesión no se desaloja
+        # mientras alguien la esté viendo
+        session.touch()
+        step, running, robots, boxes, full = readChanges(session, last)
+        if step > last:
+            event = {'currentStep': step,
+                     'running': running,
+                     'full': full,
+                     'agents': robotsToPositions(robots),
+                     'obstacles': boxesToPositions(boxes)}
+            last = step
+            yield f"id: {step}\nevent: frame\ndata: {json.dumps(event)}\n\n"
+        if not running:
+            yield "event: end\ndata: {}\n\n"
+            return
+        if not session.wait_for_step(last, KEEPALIVE_SECONDS):
+            yield ": keepalive\n\n"
+
+
+# Canal de Server-Sent Events: manda un evento "frame" con los cambios en
+# cuanto termina cada paso, ya sea de /update, /run o del avance en segundo
+# plano, y un evento "end" cuando el modelo termina. Sin "since" el primer
+# evento trae todo el estado. Al reconectarse, el navegador manda el último
+# paso recibido en Last-Event-ID
+@app.route('/stream', methods=['GET'])
+def streamModel():
+    session = getSession()
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', default=-1, type=int)
+    return Response(streamEvents(session, since),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+def getTrace():
+    # La traza viene por nombre en la URL y solo se busca en TRACE_DIR. Se
+    # abre otra vez si creció desde que se abrió, por si se sigue grabando
+    name = request.args.get('trace', '')
+    if not name or os.path.basename(name) != name:
+        raise TraceError("Invalid trace name.")
+    path = os.path.join(TRACE_DIR, name)
+    try:
+        size = os.path.getsize(path + '.idx')
+    except OSError:
+        raise TraceError("Trace not found.")
+    with traces_lock:
+        opened = traces.get(name)
+        if opened is None or opened[0] != size:
+            opened = (size, TraceReader(path))
+            traces[name] = opened
+        return opened[1]
+
+
+def recordsToPositions(records):
+    # Registros binarios de una traza al formato que espera Unity, los
+    # robots primero y luego las cajas
+    robots = (records['flags'] & ROBOT_FLAG) != 0
+    agents = [{"id": str(unique_id), "x": x, "y": .4, "z": z,
+               "box": bool(flags & HAS_BOX_FLAG)}
+              for unique_id, x, z, _, flags in records[robots].tolist()]
+    obstacles = [{"id": str(unique_id), "x": x, "y": 0.3 + 0.6 * level,
+                  "z": z}
+                 for unique_id, x, z, level, _ in records[~robots].tolist()]
+    return agents, obstacles
+
+
+# Datos de una traza grabada: tamaño del tablero, parámetros y el rango de
+# pasos que se pueden pedir
+@app.route('/replay/info', methods=['GET'])
+def replayInfo():
+    trace = getTrace()
+    return jsonify({'firstStep': trace.first_step,
+                    'lastStep': trace.last_step,
+                    'parameters': trace.meta})
+
+
+# Todos los agentes de un paso de una traza, sin crear el modelo. El paso
+# se arma desde el cuadro completo anterior y los cambios que le siguen
+@app.route('/replay/frame', methods=['GET'])
+def replayFrame():
+    trace = getTrace()
+    step = request.args.get('step', default=trace.first_step, type=int)
+    frame = trace.get_frame(step)
+    if wantsBinary():
+        return Response(frame['records'].tobytes(), mimetype=BINARY_MIMETYPE,
+                        headers={'X-Current-Step': str(step),
+                                 'X-Running': str(frame['running']).lower(),
+                                 'X-Full': 'true'})
+    agents, obstacles = recordsToPositions(frame['records'])
+    return jsonify({'currentStep': step,
+                    'running': frame['running'],
+                    'idealPositions': frame['ideal_positions'],
+                    'agents': agents,
+                    'obstacles': obstacles})
+
+
+# Varios pasos de una traza, de "start" a "stop" sin incluirlo. El primer
+# cuadro trae todos los agentes y los siguientes solo los que cambiaron en
+# su paso, como /getChanges
+@app.route('/replay/range', methods=['GET'])
+def replayRange():
+    trace = getTrace()
+    start = request.args.get('start', default=trace.first_step, type=int)
+    stop = request.args.get('stop', default=trace.last_step + 1, type=int)
+    stop = min(stop, trace.last_step + 1, start + MAX_REPLAY_STEPS)
+
+    frames = []
+    for step in range(start, stop):
+        if step == start:
+            frame = trace.get_frame(step)
+            frame['full'] = True
+        else:
+            frame = trace.get_changes(step)
+        agents, obstacles = recordsToPositions(frame['records'])
+        frames.append({'step': step,
+                       'running': frame['running'],
+                       'full': frame['full'],
+                       'agents': agents,
+                       'obstacles': obstacles})
+    return jsonify({'firstStep': trace.first_step,
+                    'lastStep': trace.last_step,
+                    'frames': frames})
+
+
 if __name__ == '__main__':
-    app.run(host="localhost", port=8585, debug=True)
+    app.run(host="localhost", port=8585, debug=True, threaded=True)
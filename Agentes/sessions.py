@@ -0,0 +1,296 @@
+"""
+Registry of the models served by the Flask server. Each session has its own
+BoxPicking model and lock, so several clients can run simulations side by
+side without overwriting each other.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from stepping import SteppingWorker
+
+# Rough memory used by a model, used to cap the total of the registry
+CELL_BYTES = 100
+AGENT_BYTES = 500
+# a box kept in the arrays of a CompactOccupancyGrid
+COMPACT_BOX_BYTES = 10
+
+
+class SessionError(Exception):
+    """
+    Raised when a session does not exist
+    """
+
+
+class CapacityError(Exception):
+    """
+    Raised when a model is too big for the server
+    """
+
+
+class Session:
+    """
+    A model together with the state the server keeps for it
+    """
+
+    def __init__(self, session_id, model, max_steps):
+        """
+        Create a new Session.
+
+        Args:
+            session_id (str): the id of the session
+            model (BoxPicking): the model of the session
+            max_steps (int): the maximum number of steps of the model
+        """
+        self.id = session_id
+        self.model = model
+        self.max_steps = max_steps
+        self.current_step = 0
+        # only one request can use the model at a time
+        self.lock = threading.RLock()
+        self.last_access = time.monotonic()
+        self.memory = estimate_memory(model)
+        # thread that steps the model in the background, if any
+        self.worker = None
+        # records and serialized bodies of the last step read by the
+        # server, None until the first read
+        self.frame_cache = None
+        # notified after every step and when the session is closed
+        self.step_condition = threading.Condition()
+        # last step finished and published, the waiting threads compare
+        # against it and not against the step in progress
+        self.last_step = model.schedule.steps
+        self.closed = False
+
+    def touch(self):
+        """
+        Mark the session as used now
+        """
+        self.last_access = time.monotonic()
+
+    def stepped(self):
+        """
+        Wake up the threads waiting for a new step of the model
+        """
+        with self.step_condition:
+            self.last_step = self.model.schedule.steps
+            self.step_condition.notify_all()
+
+    def wait_for_step(self, step, timeout=None):
+        """
+        Wait until the model goes past a step or the session is closed
+
+        Args:
+            step (int): the last step the caller knows
+            timeout (float): the maximum seconds to wait, None waits
+                forever
+
+        Returns:
+            bool: False if the time ran out first
+        """
+        with self.step_condition:
+            return self.step_condition.wait_for(
+                lambda: self.closed or self.last_step > step,
+                timeout)
+
+    def close(self):
+        """
+        Stop the background thread and wake up the threads waiting for a
+        step, they find the session closed
+        """
+        self.stop_stepping(wait=False)
+        with self.step_condition:
+            self.closed = True
+            self.step_condition.notify_all()
+
+    def start_stepping(self, rate=None):
+        """
+        Step the model in a background thread, replacing the one already
+        running
+
+        Args:
+            rate (float): the steps per second, None or 0 steps as fast as
+                possible
+        """
+        self.stop_stepping()
+        self.worker = SteppingWorker(self, rate)
+        self.worker.start()
+
+    def stop_stepping(self, wait=True):
+        """
+        Stop the background thread, if any
+
+        Args:
+            wait (bool): wait until the thread ends
+        """
+        if self.worker is not None:
+            self.worker.stop(wait)
+            self.worker = None
+
+
+def estimate_memory(model):
+    """
+    Estimate the memory used by a model
+
+    Args:
+        model (BoxPicking): the model
+
+    Returns:
+        int: the estimated number of bytes
+    """
+    return estimate_parameters_memory(model.width, model.height,
+                                      model.number_of_boxes,
+                                      len(model.schedule.agents),
+                                      model.box_storage)
+
+
+def estimate_parameters_memory(width, height, n_boxes, n_robots,
+                               box_storage="agents"):
+    """
+    Estimate the memory a model with the given parameters would use, so a
+    model can be refused before it is built
+
+    Args:
+        width (int): the width of the grid
+        height (int): the height of the grid
+        n_boxes (int): the number of boxes
+        n_robots (int): the number of robots
+        box_storage (str): "agents" or "compact"
+
+    Returns:
+        int: the estimated number of bytes
+    """
+    box_bytes = COMPACT_BOX_BYTES if box_storage == "compact" \
+        else AGENT_BYTES
+    return width * height * CELL_BYTES + n_boxes * box_bytes + \
+        n_robots * AGENT_BYTES
+
+
+class SessionRegistry:
+    """
+    Keeps the sessions in least recently used order. Sessions are evicted
+    when they are idle for too long, when there are too many of them or when
+    their estimated memory goes over the limit
+    """
+
+    def __init__(self, max_sessions=16, idle_timeout=1800,
+                 max_memory=2 * 1024 ** 3):
+        """
+        Create a new SessionRegistry.
+
+        Args:
+            max_sessions (int): the maximum number of sessions
+            idle_timeout (float): seconds without use before a session is
+                evicted
+            max_memory (int): the maximum estimated bytes of all the models
+        """
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_memory = max_memory
+        self.sessions = OrderedDict()
+        # session used by the requests that do not send an id
+        self.default_id = None
+        self.lock = threading.Lock()
+
+    def create(self, model, max_steps):
+        """
+        Register a new session for a model and make it the default one
+
+        Args:
+            model (BoxPicking): the model of the session
+            max_steps (int): the maximum number of steps of the model
+
+        Returns:
+            Session: the new session
+        """
+        session = Session(uuid.uuid4().hex, model, max_steps)
+        if session.memory > self.max_memory:
+            raise CapacityError("The model is too big for the server.")
+        with self.lock:
+            self.sessions[session.id] = session
+            self.default_id = session.id
+            self._evict()
+        return session
+
+    def check_memory(self, width, height, n_boxes, n_robots,
+                     box_storage="agents"):
+        """
+        Refuse the parameters of a model that would be too big for the
+        server, before the model is built
+
+        Args:
+            width (int): the width of the grid
+            height (int): the height of the grid
+            n_boxes (int): the number of boxes
+            n_robots (int): the number of robots
+            box_storage (str): "agents" or "compact"
+        """
+        if min(width, height, n_boxes, n_robots) < 0:
+            raise ValueError("The size of a model can not be negative")
+        if estimate_parameters_memory(width, height, n_boxes, n_robots,
+                                      box_storage) > self.max_memory:
+            raise CapacityError("The model is too big for the server.")
+
+    def get(self, session_id=None):
+        """
+        Returns a session and marks it as used
+
+        Args:
+            session_id (str): the id of the session, None for the default
+
+        Returns:
+            Session: the session
+        """
+        with self.lock:
+            self._evict()
+            if session_id is None:
+                session_id = self.default_id
+            session = self.sessions.get(session_id)
+            if session is None:
+                raise SessionError("Session not found, call /init first.")
+            session.touch()
+            self.sessions.move_to_end(session_id)
+            return session
+
+    def remove(self, session_id):
+        """
+        Remove a session
+
+        Args:
+            session_id (str): the id of the session
+        """
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+            if session is not None:
+                session.close()
+            if self.default_id == session_id:
+                self.default_id = None
+
+    def _evict(self):
+        """
+        Evict idle sessions, then the least recently used ones while there
+        are too many or they use too much memory. The caller holds the lock
+        """
+        now = time.monotonic()
+        for session_id, session in list(self.sessions.items()):
+            if now - session.last_access > self.idle_timeout:
+                self._pop(session_id)
+
+        while len(self.sessions) > self.max_sessions or \
+                self.memory() > self.max_memory:
+            self._pop(next(iter(self.sessions)))
+
+    def _pop(self, session_id):
+        self.sessions.pop(session_id).close()
+        if self.default_id == session_id:
+            self.default_id = None
+
+    def memory(self):
+        """
+        Returns the estimated memory of all the sessions
+
+        Returns:
+            int: the estimated number of bytes
+        """
+        return sum(session.memory for session in self.sessions.values())
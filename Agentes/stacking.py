@@ -0,0 +1,74 @@
+class StackingAllocator:
+    """
+    Hands out the positions where the boxes are stacked. The cells are
+    visited row by row, from left to right, and a cursor remembers the last
+    position given so the next one is found without walking the grid again.
+    An allocator can use only a rectangle of the grid, so several stacking
+    zones can share it. A cell that could not be used yet is deferred and
+    given again before the next new cell
+    """
+
+    def __init__(self, width, height, start=(0, 0), origin=(0, 0)):
+        """
+        Create a new StackingAllocator.
+
+        Args:
+            width (int): the width of the grid or of the zone
+            height (int): the height of the grid or of the zone
+            start (tuple): the first stacking position
+            origin (tuple): the bottom left cell of the zone
+        """
+        self.width = width
+        self.height = height
+        self.origin = origin
+        # number of the current cell in the order the cells are used
+        self.cursor = (start[1] - origin[1]) * width + start[0] - origin[0]
+        self.deferred = []
+
+    def position(self, number):
+        """
+        Returns the cell with the given number in the order the cells are
+        used
+
+        Args:
+            number (int): the number of the cell
+
+        Returns:
+            tuple: the coordinates of the cell
+        """
+        y, x = divmod(number, self.width)
+        return (self.origin[0] + x, self.origin[1] + y)
+
+    def current(self):
+        """
+        Returns the position the cursor points to
+
+        Returns:
+            tuple: the coordinates of the current stacking position
+        """
+        return self.position(self.cursor)
+
+    def advance(self):
+        """
+        Move the cursor to the next cell, the deferred cells are given
+        first
+
+        Returns:
+            tuple: the coordinates of the next cell, None if the allocator
+                has no more cells
+        """
+        if self.deferred:
+            return self.deferred.pop(0)
+        if self.cursor + 1 >= self.width * self.height:
+            return None
+        self.cursor += 1
+        return self.position(self.cursor)
+
+    def defer(self, positions):
+        """
+        Give some cells again on the next calls to advance
+
+        Args:
+            positions (list): the coordinates of the cells
+        """
+        self.deferred.extend(positions)
@@ -0,0 +1,265 @@
+"""
+Background stepping of the model of a session. A worker thread steps the
+model at a fixed rate and publishes every finished step in a double
+buffered frame, so the requests that read the agents get the last finished
+step right away instead of waiting for the step in progress. The requests
+that need the model itself, like a checkpoint, hand a function to the
+thread, that runs it between two steps.
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+
+class Frame:
+    """
+    The records of every agent of a model after a step
+    """
+
+    def __init__(self, step, running, robots, boxes, metrics=None):
+        """
+        Create a new Frame.
+
+        Args:
+            step (int): the step of the model
+            running (bool): whether the model was still running
+            robots (dict): the robot records by unique id
+            boxes (dict): the box records by unique id
+            metrics (dict): the measures of the profiler of the model, None
+                if it has none
+        """
+        self.step = step
+        self.running = running
+        self.robots = robots
+        self.boxes = boxes
+        self.metrics = metrics
+
+
+class FrameBuffer:
+    """
+    Two frames of a model. The readers use the front frame while the
+    stepping thread brings the back frame up to date with the changes of
+    the last steps, then both frames are swapped
+    """
+
+    def __init__(self, model):
+        """
+        Create a new FrameBuffer with both frames at the current step.
+
+        Args:
+            model (BoxPicking): the model, the caller holds its lock
+        """
+        robots, boxes = model.get_snapshot()
+        step = model.schedule.steps
+        metrics = get_metrics(model)
+        self.frames = [Frame(step, model.running, robots, boxes, metrics),
+                       Frame(step, model.running, dict(robots), dict(boxes),
+                             metrics)]
+        self.front = 0
+        # changes already in the front frame but not in the back one
+        self.pending = None
+        # the changes of the published steps, as the change log of the model
+        self.changes = deque(model.change_log, maxlen=model.change_log.maxlen)
+        # held by the readers of the front frame and by the swap
+        self.lock = threading.Lock()
+
+    def publish(self, model):
+        """
+        Update the back frame with the step the model just did and make it
+        the front frame
+
+        Args:
+            model (BoxPicking): the model, the caller holds its lock
+        """
+        back = self.frames[1 - self.front]
+        if model.change_log:
+            changes = model.change_log[-1]
+            for records in (self.pending, changes):
+                if records is not None:
+                    _, robots, boxes = records
+                    back.robots.update(robots)
+                    back.boxes.update(boxes)
+        else:
+            # a model without a change log, the back frame is rebuilt
+            changes = None
+            back.robots, back.boxes = model.get_snapshot()
+        back.step = model.schedule.steps
+        back.running = model.running
+        back.metrics = get_metrics(model)
+        with self.lock:
+            self.front = 1 - self.front
+            if changes is not None:
+                self.changes.append(changes)
+        self.pending = changes
+
+    @contextmanager
+    def read(self):
+        """
+        Use the front frame, it does not change until the block ends. Keep
+        the block short, the stepping thread waits for it to swap
+
+        Yields:
+            Frame: the last published frame
+        """
+        with self.lock:
+            yield self.frames[self.front]
+
+    def get_changes_since(self, step):
+        """
+        Returns the records of the agents that changed after a step in the
+        published frames, like BoxPicking.get_changes_since
+
+        Args:
+            step (int): the last step the caller knows
+
+        Returns:
+            tuple: the step and whether the model was running in the front
+                frame, the robot records and the box records by unique id
+                and whether the records are every agent, because the
+                changes do not go back to that step
+        """
+        with self.lock:
+            frame = self.frames[self.front]
+            current = frame.step
+            running = frame.running
+            changes = list(self.changes)
+            if step < current and \
+                    (not changes or changes[0][0] > step + 1):
+                return current, running, dict(frame.robots), \
+                    dict(frame.boxes), True
+        robots = {}
+        boxes = {}
+        for logged_step, step_robots, step_boxes in changes:
+            if step < logged_step <= current:
+                robots.update(step_robots)
+                boxes.update(step_boxes)
+        return current, running, robots, boxes, False
+
+
+def get_metrics(model):
+    if model.profiler is None:
+        return None
+    return model.profiler.get_metrics()
+
+
+class SteppingWorker:
+    """
+    A thread that steps the model of a session until it stops
+    """
+
+    def __init__(self, session, rate=None):
+        """
+        Create a new SteppingWorker, call start to run it.
+
+        Args:
+            session (Session): the session of the model
+            rate (float): the steps per second, None or 0 steps as fast as
+                possible
+        """
+        self.session = session
+        self.interval = 1 / rate if rate else 0
+        with session.lock:
+            self.frames = FrameBuffer(session.model)
+        self.stop_event = threading.Event()
+        # set to run the functions handed to the thread without waiting
+        # for the next step
+        self.wake = threading.Event()
+        self.tasks = []
+        self.tasks_lock = threading.Lock()
+        # False once the thread ended, the functions run in the caller
+        self.accepting = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, wait=True):
+        """
+        Stop stepping after the current step
+
+        Args:
+            wait (bool): wait until the thread ends
+        """
+        self.stop_event.set()
+        self.wake.set()
+        if wait and self.thread.is_alive() and \
+                threading.current_thread() is not self.thread:
+            self.thread.join()
+
+    def call(self, function):
+        """
+        Run a function with the model between two steps, the requests use
+        it instead of waiting for the lock of the session while the thread
+        steps
+
+        Args:
+            function (callable): called with the model
+
+        Returns:
+            object: what the function returns
+        """
+        future = Future()
+        with self.tasks_lock:
+            accepting = self.accepting
+            if accepting:
+                self.tasks.append((function, future))
+        if not accepting:
+            with self.session.lock:
+                return function(self.session.model)
+        self.wake.set()
+        return future.result()
+
+    def run_tasks(self):
+        """
+        Run the functions handed to the thread, the caller holds the lock
+        of the session
+        """
+        with self.tasks_lock:
+            tasks, self.tasks = self.tasks, []
+        for function, future in tasks:
+            try:
+                future.set_result(function(self.session.model))
+            except Exception as error:
+                future.set_exception(error)
+
+    def run(self):
+        """
+        Step the model and publish the frame of every step, waiting between
+        steps to keep the rate. A step that takes longer than the interval
+        is not made up for, the next one starts right after it. When the
+        model stops the thread ends and leaves the session without a worker
+        """
+        session = self.session
+        next_step = time.monotonic()
+        try:
+            while not self.stop_event.is_set():
+                self.wake.clear()
+                stepped = False
+                with session.lock:
+                    self.run_tasks()
+                    if time.monotonic() >= next_step:
+                        model = session.model
+                        if not model.running:
+                            break
+                        model.step()
+                        session.current_step += 1
+                        self.frames.publish(model)
+                        stepped = True
+                        next_step = max(next_step + self.interval,
+                                        time.monotonic())
+                if stepped:
+                    session.stepped()
+                if self.interval:
+                    self.wake.wait(next_step - time.monotonic())
+                else:
+                    # let the request threads take the lock
+                    time.sleep(0)
+        finally:
+            with self.tasks_lock:
+                self.accepting = False
+            with session.lock:
+                self.run_tasks()
+            if session.worker is self:
+                session.worker = None
@@ -0,0 +1,213 @@
+"""
+Data collection for long runs. The Mesa DataCollector keeps every step in
+memory; the StreamingCollector keeps only the rows of the current chunk in
+a fixed-size NumPy buffer and appends every full chunk to disk, so the
+memory of a run does not grow with its number of steps.
+
+The data of a run is written to a directory, as a CSV file per table or as
+one NumPy file per chunk and table. The model table has a row per step and
+the agent table a row per robot and step.
+
+Example:
+    model.stream_data("run-data", chunk_size=1000, file_format="npy")
+    while model.running:
+        model.step()
+    steps = load_data("run-data", file_format="npy")
+"""
+import csv
+import glob
+import os
+
+import numpy as np
+
+FILE_FORMATS = ("csv", "npy")
+
+
+class ChunkWriter:
+    """
+    A table whose rows are kept in a NumPy buffer and written to disk when
+    the buffer is full
+    """
+
+    def __init__(self, directory, name, columns, chunk_size, file_format):
+        """
+        Create a new ChunkWriter and remove the files of a previous table
+        with the same name.
+
+        Args:
+            directory (str): the directory of the files
+            name (str): the name of the table
+            columns (list): the names of the columns
+            chunk_size (int): the number of rows written at once
+            file_format (str): "csv" to append to one CSV file or "npy" to
+                write a NumPy file per chunk
+        """
+        self.directory = directory
+        self.name = name
+        self.columns = list(columns)
+        self.chunk_size = chunk_size
+        self.file_format = file_format
+        # the buffer is created with the first row, which gives the type of
+        # every column
+        self.buffer = None
+        self.rows = 0
+        self.chunks = 0
+
+        for path in glob.glob(os.path.join(directory, f"{name}_*.npy")):
+            os.remove(path)
+        if file_format == "csv":
+            with open(self.csv_path, "w", newline="") as output:
+                csv.writer(output).writerow(self.columns)
+
+    @property
+    def csv_path(self):
+        return os.path.join(self.directory, f"{self.name}.csv")
+
+    def append(self, row):
+        """
+        Add a row to the buffer, writing the buffer first if it is full
+
+        Args:
+            row (tuple): the values of the row, in the order of the columns
+        """
+        if self.buffer is None:
+            dtype = [(column, np.float64 if isinstance(value, float)
+                      else np.int64)
+                     for column, value in zip(self.columns, row)]
+            self.buffer = np.zeros(self.chunk_size, dtype=dtype)
+        elif self.rows == self.chunk_size:
+            self.flush()
+        self.buffer[self.rows] = row
+        self.rows += 1
+
+    def flush(self):
+        """
+        Write the rows in the buffer and empty it
+        """
+        if not self.rows:
+            return
+        chunk = self.buffer[:self.rows]
+        if self.file_format == "csv":
+            with open(self.csv_path, "a", newline="") as output:
+                csv.writer(output).writerows(chunk.tolist())
+        else:
+            np.save(os.path.join(self.directory,
+                                 f"{self.name}_{self.chunks:05d}.npy"),
+                    chunk)
+        self.chunks += 1
+        self.rows = 0
+
+
+class StreamingCollector:
+    """
+    Collects model and agent reporters like the Mesa DataCollector, but
+    writes them to disk in chunks instead of keeping them
+    """
+
+    def __init__(self, path, model_reporters, agent_reporters=None,
+                 chunk_size=1000, file_format="csv"):
+        """
+        Create a new StreamingCollector.
+
+        Args:
+            path (str): the directory where the tables are written, created
+                if it does not exist
+            model_reporters (dict): the functions of the model columns by
+                name, each one receives the model
+            agent_reporters (dict): the functions of the agent columns by
+                name, each one receives a robot. None writes no agent table
+            chunk_size (int): the number of rows of a table kept in memory
+            file_format (str): "csv" or "npy"
+        """
+        if file_format not in FILE_FORMATS:
+            raise ValueError(f"Unknown file format: {file_format}")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.model_reporters = dict(model_reporters)
+        self.agent_reporters = dict(agent_reporters or {})
+        self.model_table = ChunkWriter(
+            path, "model", ["step"] + list(self.model_reporters),
+            chunk_size, file_format)
+        self.agent_table = None
+        if agent_reporters:
+            self.agent_table = ChunkWriter(
+                path, "agents",
+                ["step", "unique_id"] + list(self.agent_reporters),
+                chunk_size, file_format)
+
+    def collect(self, model):
+        """
+        Add the row of the current step of the model and, if there is an
+        agent table, a row for each robot
+
+        Args:
+            model (BoxPicking): the model
+        """
+        step = model.schedule.steps
+        self.model_table.append(
+            (step,) + tuple(reporter(model)
+                            for reporter in self.model_reporters.values()))
+        if self.agent_table is not None:
+            for robot in model.schedule.agents:
+                self.agent_table.append(
+                    (step, robot.unique_id) +
+                    tuple(reporter(robot)
+                          for reporter in self.agent_reporters.values()))
+
+    def flush(self):
+        """
+        Write the rows that are still in memory, called when the model
+        stops or before reading the files of a run that goes on
+        """
+        self.model_table.flush()
+        if self.agent_table is not None:
+            self.agent_table.flush()
+
+
+class StalledRobots:
+    """
+    Model reporter with the number of robots that are in the same cell and
+    carry the same box as the last time it was called
+    """
+
+    def __init__(self, model):
+        """
+        Create a new StalledRobots reporter.
+
+        Args:
+            model (BoxPicking): the model, with its robots already placed
+        """
+        self.last_states = self.get_states(model)
+
+    @staticmethod
+    def get_states(model):
+        return [(robot.pos, robot.box) for robot in model.schedule.agents]
+
+    def __call__(self, model):
+        states = self.get_states(model)
+        stalled = sum(state == last
+                      for state, last in zip(states, self.last_states))
+        self.last_states = states
+        return stalled
+
+
+def load_data(path, table="model", file_format="csv"):
+    """
+    Read a table written by a StreamingCollector
+
+    Args:
+        path (str): the directory of the run
+        table (str): "model" or "agents"
+        file_format (str): the format the table was written in
+
+    Returns:
+        numpy.ndarray: a structured array with a field per column
+    """
+    if file_format == "csv":
+        return np.genfromtxt(os.path.join(path, f"{table}.csv"),
+                             delimiter=",", names=True, dtype=None,
+                             ndmin=1)
+    chunks = sorted(glob.glob(os.path.join(path, f"{table}_*.npy")))
+    if not chunks:
+        raise ValueError(f"No chunks of the {table} table in {path}")
+    return np.concatenate([np.load(chunk) for chunk in chunks])